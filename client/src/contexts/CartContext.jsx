@@ -211,20 +211,26 @@ export function CartProvider({ children }) {
 
   const updateQuantity = async (id, quantity) => {
     if (mode === "api") {
-      const updatedItems = state.items.map(item =>
-        item.id === id ? { ...item, quantity } : item
-      ).filter(item => item.quantity > 0);
+      // Send only the changed line; the server returns affected lines and removed ids
       const res = await fetch("/api/cart", {
-        method: "PUT",
+        method: "PATCH",
         headers: { "Content-Type": "application/json" },
         credentials: "include",
-        body: JSON.stringify({ items: updatedItems }),
+        body: JSON.stringify({
+          operations: [quantity > 0 ? { op: "set", productId: id, quantity } : { op: "remove", productId: id }],
+        }),
       });
       const data = await res.json().catch(() => ({}));
       if (!res.ok) {
         throw new Error(data.message || "Failed to update cart");
       }
-      syncApiCart(data.items || []);
+      const affected = new Map((data.items || []).map(item => [item.id, item]));
+      const removed = new Set(data.removed || []);
+      syncApiCart(
+        state.items
+          .filter(item => !removed.has(item.id))
+          .map(item => affected.get(item.id) || item)
+      );
     } else {
       dispatch({ type: "UPDATE_QUANTITY", payload: { id, quantity } });
     }
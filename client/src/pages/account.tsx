@@ -5,9 +5,11 @@ import { Button } from "@/components/ui/button";
 import { Input } from "@/components/ui/input";
 import { Label } from "@/components/ui/label";
 import { ArrowLeft, MapPin, CreditCard, Bell, HelpCircle, LogOut, Package, Settings } from "lucide-react";
-import { useQuery, useQueryClient } from "@tanstack/react-query";
+import { useInfiniteQuery, useQuery, useQueryClient } from "@tanstack/react-query";
 import { useToast } from "@/hooks/use-toast";
 
+const ORDERS_PAGE_SIZE = 20;
+
 export default function Account() {
   const [, navigate] = useLocation();
   const { toast } = useToast();
@@ -43,22 +45,35 @@ export default function Account() {
     })();
   }, [navigate]);
 
-  // Fetch user orders
-  const { data: orders = [], isLoading: ordersLoading } = useQuery({
+  // Fetch user orders, a page at a time (newest first)
+  const {
+    data: orderPages,
+    isLoading: ordersLoading,
+    hasNextPage: hasMoreOrders,
+    fetchNextPage: fetchMoreOrders,
+    isFetchingNextPage: loadingMoreOrders,
+  } = useInfiniteQuery({
     queryKey: ["/api/orders"],
     enabled: !!me,
-    queryFn: async () => {
-      const res = await fetch("/api/orders", { credentials: "include" });
+    initialPageParam: "",
+    queryFn: async ({ pageParam }) => {
+      const params = new URLSearchParams({ limit: String(ORDERS_PAGE_SIZE) });
+      if (pageParam) {
+        params.set("after", pageParam);
+      }
+      const res = await fetch(`/api/orders?${params}`, { credentials: "include" });
       if (!res.ok) {
         if (res.status === 401 || res.status === 404) {
-          return [];
+          return { items: [], nextCursor: null };
         }
         throw new Error("Failed to fetch orders");
       }
-      return res.json();
+      return res.json() as Promise<{ items: any[]; nextCursor: string | null }>;
     },
+    getNextPageParam: (lastPage) => lastPage.nextCursor ?? undefined,
     refetchInterval: 5000,
   });
+  const orders = orderPages?.pages.flatMap((page) => page.items) ?? [];
 
   // Fetch saved addresses
   const { data: addresses = [], isLoading: addressesLoading } = useQuery({
@@ -356,6 +371,16 @@ export default function Account() {
                         </div>
                       );
                     })}
+                    {hasMoreOrders && (
+                      <Button
+                        variant="outline"
+                        className="w-full"
+                        onClick={() => fetchMoreOrders()}
+                        disabled={loadingMoreOrders}
+                      >
+                        {loadingMoreOrders ? "Loading..." : "Load more orders"}
+                      </Button>
+                    )}
                   </div>
                 )}
               </CardContent>
@@ -6,6 +6,7 @@ from flask import Flask
 
 from config import config
 from db import Base, engine
+import product_search
 from routes_products import bp_products
 from routes_categories import bp_categories
 from routes_orders import bp_orders
@@ -28,6 +29,7 @@ def create_app() -> Flask:
 
     # Initialize DB schema
     Base.metadata.create_all(engine)
+    product_search.ensure_index(engine)
 
     # Register blueprints
     app.register_blueprint(bp_products)
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Regression benchmark: the number of SQL statements issued by a cart request
+must not grow with the number of line items.
+
+Runs against a throwaway SQLite database, so it is safe to run anywhere:
+
+    cd server && python bench_cart_queries.py
+"""
+
+from __future__ import annotations
+
+import os
+import sys
+import tempfile
+import time
+
+_tmpdir = tempfile.mkdtemp(prefix="cart-bench-")
+os.environ["DATABASE_URL"] = f"sqlite:///{_tmpdir}/bench.db"
+os.environ.setdefault("FLASK_SECRET_KEY", "cart-bench")
+
+from sqlalchemy import event  # noqa: E402
+
+from app import app  # noqa: E402
+from db import Product, SessionLocal, User, engine  # noqa: E402
+
+CART_SIZES = [1, 10, 40]
+ROUNDS = 50
+
+
+class QueryCounter:
+    def __init__(self) -> None:
+        self.count = 0
+
+    def __call__(self, *args, **kwargs) -> None:
+        self.count += 1
+
+
+def seed() -> int:
+    with SessionLocal() as db:
+        for i in range(max(CART_SIZES)):
+            db.add(Product(
+                name=f"Bench product {i}",
+                price=100.0 + i,
+                image="",
+                category="bench",
+                stock_quantity=1000,
+                in_stock=True,
+            ))
+        user = User(username="bench", email="bench@example.com", password_hash="x", name="Bench")
+        db.add(user)
+        db.commit()
+        return user.id
+
+
+def measure(client, method: str, payload_for=lambda i: None):
+    # One untimed request first so the cart row exists before counting
+    client.open("/api/cart", method=method, json=payload_for(-1))
+    counter = QueryCounter()
+    event.listen(engine, "before_cursor_execute", counter)
+    try:
+        start = time.perf_counter()
+        for i in range(ROUNDS):
+            r = client.open("/api/cart", method=method, json=payload_for(i))
+            assert r.status_code == 200, r.get_data(as_text=True)
+        elapsed = (time.perf_counter() - start) / ROUNDS
+    finally:
+        event.remove(engine, "before_cursor_execute", counter)
+    return counter.count / ROUNDS, elapsed * 1000
+
+
+def main() -> int:
+    user_id = seed()
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess["user_id"] = user_id
+
+    results = {}
+    for size in CART_SIZES:
+        # Alternate quantities so every PUT really rewrites the cart
+        put_queries, put_ms = measure(client, "PUT", lambda i, size=size: {
+            "items": [{"id": pid, "quantity": 1 + i % 2} for pid in range(1, size + 1)]
+        })
+        get_queries, get_ms = measure(client, "GET")
+        results[size] = (get_queries, put_queries)
+        print(f"{size:>3} items: GET {get_queries:g} queries {get_ms:.2f} ms | "
+              f"PUT {put_queries:g} queries {put_ms:.2f} ms")
+
+    baseline = results[CART_SIZES[0]]
+    regressions = [size for size, counts in results.items() if counts != baseline]
+    if regressions:
+        print(f"FAIL: query count grows with cart size ({regressions})")
+        return 1
+    print("OK: queries per cart request are constant")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,220 @@
+from __future__ import annotations
+
+import json
+import threading
+from bisect import bisect_right
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import select, update
+from sqlalchemy.orm import Session
+
+from config import config
+from db import CatalogVersion, Category, Product, SessionLocal
+
+# The catalog version lives in the database so every worker sees a bump made
+# by any other worker; each worker keeps its own serialized copy per version,
+# or maps the shared one when CATALOG_SNAPSHOT_DIR is set. Stock has its own
+# version (a second row) because checkouts move it constantly: a stock bump
+# only re-reads stock and patches the products it changed.
+_CATALOG_ROW_ID = 1
+_STOCK_ROW_ID = 2
+
+# Fields of a serialized product that a stock change can touch
+STOCK_FIELDS = ("stockQuantity", "inStock", "updatedAt")
+
+_lock = threading.Lock()
+_snapshot: Optional["CatalogSnapshot"] = None
+
+
+def serialize_product(p: Product) -> Dict[str, Any]:
+    return {
+        "id": p.id,
+        "name": p.name,
+        "description": p.description or "",
+        "price": float(p.price) if p.price is not None else 0,
+        "image": p.image or "",
+        "category": p.category or "",
+        "size": p.size or "",
+        "stockQuantity": int(p.stock_quantity) if p.stock_quantity is not None else 0,
+        "inStock": bool(p.in_stock) if p.in_stock is not None else False,
+        "deliveryPrice": float(p.delivery_price) if p.delivery_price is not None else 0,
+        "discount": float(p.discount) if p.discount is not None else 0,
+        "createdAt": p.created_at.isoformat() if p.created_at else "",
+        "updatedAt": p.updated_at.isoformat() if p.updated_at else ""
+    }
+
+
+def encode(data: Any) -> bytes:
+    return json.dumps(data, separators=(",", ":")).encode("utf-8")
+
+
+def page_body(items: bytes, next_cursor: Optional[str]) -> bytes:
+    return b'{"items":' + items + b',"nextCursor":' + encode(next_cursor) + b"}"
+
+
+@dataclass
+class CatalogSnapshot:
+    """
+    Serialized catalog for one version. Routes only use the *_json methods,
+    which the shared-memory snapshot in catalog_snapshot implements as well.
+    """
+    version: int
+    stock_version: int
+    products: List[Dict[str, Any]]  # ordered by id
+    by_id: Dict[int, Dict[str, Any]]
+    by_category: Dict[str, List[Dict[str, Any]]]
+    categories: List[Dict[str, Any]]
+    _encoded: Dict[str, bytes] = field(default_factory=dict)
+
+    @property
+    def etag(self) -> str:
+        return etag_for(self.version, self.stock_version)
+
+    def _products_in(self, category: Optional[str]) -> List[Dict[str, Any]]:
+        if category:
+            return self.by_category.get(category, [])
+        return self.products
+
+    def _cached(self, key: str, build) -> bytes:
+        # JSON bodies are encoded once per version and reused until the next bump
+        body = self._encoded.get(key)
+        if body is None:
+            body = encode(build())
+            self._encoded[key] = body
+        return body
+
+    def product_json(self, pid: int) -> Optional[bytes]:
+        product = self.by_id.get(pid)
+        return encode(product) if product else None
+
+    def list_json(self, category: Optional[str]) -> bytes:
+        return self._cached(f"products:{category or ''}", lambda: self._products_in(category))
+
+    def page_json(self, category: Optional[str], after_id: Optional[int], limit: int) -> bytes:
+        items = self._products_in(category)
+        start = bisect_right(items, after_id, key=lambda p: p["id"]) if after_id is not None else 0
+        page = items[start:start + limit + 1]
+        has_more = len(page) > limit
+        page = page[:limit]
+        return page_body(encode(page), str(page[-1]["id"]) if has_more else None)
+
+    def categories_json(self) -> bytes:
+        return self._cached("categories", lambda: self.categories)
+
+    def with_stock(self, db: Session, stock_version: int) -> "CatalogSnapshot":
+        """Copy of this snapshot with current stock; only products whose stock moved are replaced"""
+        levels = stock_levels(db)
+        products = []
+        changed = False
+        for p in self.products:
+            level = levels.get(p["id"])
+            if level is not None and any(p[k] != v for k, v in level.items()):
+                p = {**p, **level}
+                changed = True
+            products.append(p)
+        if not changed:
+            return CatalogSnapshot(self.version, stock_version, self.products, self.by_id,
+                                   self.by_category, self.categories, self._encoded)
+        snap = _index(self.version, stock_version, products, self.categories)
+        snap._encoded["categories"] = self.categories_json()
+        return snap
+
+
+def etag_for(version: int, stock_version: int) -> str:
+    return f"catalog-{version}.{stock_version}"
+
+
+def current_version(db: Session) -> Tuple[int, int]:
+    """(catalog version, stock version)"""
+    versions = dict(db.execute(
+        select(CatalogVersion.id, CatalogVersion.version)
+        .where(CatalogVersion.id.in_((_CATALOG_ROW_ID, _STOCK_ROW_ID)))
+    ).all())
+    return versions.get(_CATALOG_ROW_ID, 0), versions.get(_STOCK_ROW_ID, 0)
+
+
+def current_etag() -> str:
+    """ETag of the live catalog, for reads served from SQL rather than the snapshot"""
+    with SessionLocal() as db:
+        return etag_for(*current_version(db))
+
+
+def _bump(db: Session, row_id: int) -> None:
+    result = db.execute(
+        update(CatalogVersion)
+        .where(CatalogVersion.id == row_id)
+        .values(version=CatalogVersion.version + 1)
+    )
+    if result.rowcount == 0:
+        db.add(CatalogVersion(id=row_id, version=1))
+
+
+def bump_version(db: Session) -> None:
+    """Invalidate every worker's catalog cache (a full rebuild); commits with the caller's transaction"""
+    _bump(db, _CATALOG_ROW_ID)
+
+
+def bump_stock_version(db: Session) -> None:
+    """Refresh stock in every worker's catalog cache; commits with the caller's transaction"""
+    _bump(db, _STOCK_ROW_ID)
+
+
+def stock_levels(db: Session) -> Dict[int, Dict[str, Any]]:
+    """The STOCK_FIELDS of every product, serialized as serialize_product does"""
+    return {
+        pid: {
+            "stockQuantity": int(quantity) if quantity is not None else 0,
+            "inStock": bool(in_stock) if in_stock is not None else False,
+            "updatedAt": updated_at.isoformat() if updated_at else "",
+        }
+        for pid, quantity, in_stock, updated_at in db.execute(
+            select(Product.id, Product.stock_quantity, Product.in_stock, Product.updated_at)
+        )
+    }
+
+
+def get_snapshot():
+    """
+    Current catalog snapshot. A catalog bump rebuilds (or re-maps) it; a
+    stock bump only patches the stock of the products that changed.
+    """
+    global _snapshot
+    with SessionLocal() as db:
+        version, stock_version = current_version(db)
+        if config.catalog_snapshot_dir:
+            import catalog_snapshot
+            return catalog_snapshot.get_shared_snapshot(db, version, stock_version)
+        snap = _snapshot
+        if snap is not None and snap.version == version and snap.stock_version == stock_version:
+            return snap
+        with _lock:
+            if _snapshot is None or _snapshot.version != version:
+                _snapshot = build_snapshot(db, version, stock_version)
+            elif _snapshot.stock_version != stock_version:
+                _snapshot = _snapshot.with_stock(db, stock_version)
+            return _snapshot
+
+
+def _index(version: int, stock_version: int, products: List[Dict[str, Any]],
+           categories: List[Dict[str, Any]]) -> CatalogSnapshot:
+    by_category: Dict[str, List[Dict[str, Any]]] = {}
+    for p in products:
+        by_category.setdefault(p["category"], []).append(p)
+    return CatalogSnapshot(
+        version=version,
+        stock_version=stock_version,
+        products=products,
+        by_id={p["id"]: p for p in products},
+        by_category=by_category,
+        categories=categories,
+    )
+
+
+def build_snapshot(db: Session, version: int, stock_version: int) -> CatalogSnapshot:
+    products = [serialize_product(p) for p in db.scalars(select(Product).order_by(Product.id))]
+    categories = [
+        {"id": c.id, "name": c.name, "icon": c.icon}
+        for c in db.scalars(select(Category).order_by(Category.id))
+    ]
+    return _index(version, stock_version, products, categories)
@@ -0,0 +1,260 @@
+"""
+Read-only catalog snapshot shared by every gunicorn worker through a
+memory-mapped file.
+
+One worker (whichever first sees a new catalog version and wins the build
+lock) serializes the Product table into ``catalog-<version>.snap`` and
+renames it into place; every worker then maps that same file, so the pages
+live once in the OS page cache instead of once per process. Older
+generations are unlinked after the swap; workers still holding a mapping
+keep reading it until they move to the new version. Stock changes don't
+produce a generation: each worker overlays re-encoded copies of just the
+products whose stock moved since the file was written.
+
+File layout (little-endian)::
+
+    b"GCATSNP1" | header length (Q) | header JSON | data
+
+The header records, for the whole catalog and for each category, the
+location of a ready-to-send JSON array in ``data`` plus an id-sorted index
+of ``(id, offset, length)`` entries pointing at each product object inside
+that array, and the stock version the products were serialized at.
+Offsets are relative to the start of ``data``.
+"""
+
+from __future__ import annotations
+
+import fcntl
+import json
+import logging
+import copy
+import mmap
+import os
+import struct
+import threading
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+import catalog_cache
+from config import config
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"GCATSNP1"
+_HEADER_LEN = struct.Struct("<Q")
+_ENTRY = struct.Struct("<qQI")  # product id, offset, length
+
+_lock = threading.Lock()
+_current: Optional["SharedCatalogSnapshot"] = None
+
+
+class SharedCatalogSnapshot:
+    def __init__(self, path: Path) -> None:
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mm[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"Not a catalog snapshot: {path}")
+        (header_len,) = _HEADER_LEN.unpack_from(self._mm, len(MAGIC))
+        start = len(MAGIC) + _HEADER_LEN.size
+        header = json.loads(self._mm[start:start + header_len])
+        self._base = start + header_len
+        self.version: int = header["version"]
+        self._all: List[int] = header["all"]
+        self._categories: Dict[str, List[int]] = header["categories"]
+        self._categories_body: List[int] = header["categoriesBody"]
+        # Stock version as of the build (-1 for files written before it was
+        # recorded); later stock bumps are overlaid, not rewritten
+        self.stock_version: int = header.get("stockVersion", -1)
+        self._baked: Optional[Dict[int, Dict[str, Any]]] = None
+        self._patched: Dict[int, bytes] = {}
+        self._bodies: Dict[Optional[str], bytes] = {}
+
+    @property
+    def etag(self) -> str:
+        return catalog_cache.etag_for(self.version, self.stock_version)
+
+    def _slice(self, offset: int, length: int) -> bytes:
+        start = self._base + offset
+        return self._mm[start:start + length]
+
+    def _group(self, category: Optional[str]) -> Optional[List[int]]:
+        return self._categories.get(category) if category else self._all
+
+    def _entry(self, group: List[int], k: int) -> Tuple[int, int, int]:
+        return _ENTRY.unpack_from(self._mm, self._base + group[2] + k * _ENTRY.size)
+
+    def _bisect(self, group: List[int], product_id: int) -> int:
+        """Position of the first entry whose id is greater than product_id"""
+        lo, hi = 0, group[3]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._entry(group, mid)[0] <= product_id:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _product(self, product_id: int, offset: int, length: int) -> bytes:
+        body = self._patched.get(product_id)
+        return body if body is not None else self._slice(offset, length)
+
+    def _entries(self, group: List[int]):
+        return (self._entry(group, k) for k in range(group[3]))
+
+    def product_json(self, pid: int) -> Optional[bytes]:
+        k = self._bisect(self._all, pid) - 1
+        if k < 0:
+            return None
+        product_id, offset, length = self._entry(self._all, k)
+        return self._product(product_id, offset, length) if product_id == pid else None
+
+    def list_json(self, category: Optional[str]) -> bytes:
+        group = self._group(category)
+        if not group:
+            return b"[]"
+        if not self._patched:
+            return self._slice(group[0], group[1])
+        body = self._bodies.get(category)
+        if body is None:
+            body = b"[" + b",".join(self._product(*entry) for entry in self._entries(group)) + b"]"
+            self._bodies[category] = body
+        return body
+
+    def page_json(self, category: Optional[str], after_id: Optional[int], limit: int) -> bytes:
+        group = self._group(category)
+        if not group:
+            return catalog_cache.page_body(b"[]", None)
+        start = self._bisect(group, after_id) if after_id is not None else 0
+        end = min(start + limit, group[3])
+        entries = [self._entry(group, k) for k in range(start, end)]
+        items = b"[" + b",".join(self._product(*entry) for entry in entries) + b"]"
+        has_more = end < group[3]
+        return catalog_cache.page_body(items, str(entries[-1][0]) if has_more and entries else None)
+
+    def categories_json(self) -> bytes:
+        return self._slice(*self._categories_body)
+
+    def with_stock(self, db: Session, stock_version: int) -> "SharedCatalogSnapshot":
+        """Same mapping with current stock overlaid on the products whose stock moved"""
+        if self._baked is None:
+            # Stock as written into the file, decoded once per generation
+            self._baked = {}
+            for product_id, offset, length in self._entries(self._all):
+                product = json.loads(self._slice(offset, length))
+                self._baked[product_id] = {k: product[k] for k in catalog_cache.STOCK_FIELDS}
+        patched = {}
+        for product_id, level in catalog_cache.stock_levels(db).items():
+            baked = self._baked.get(product_id)
+            if baked is not None and baked != level:
+                k = self._bisect(self._all, product_id) - 1
+                _, offset, length = self._entry(self._all, k)
+                patched[product_id] = catalog_cache.encode({**json.loads(self._slice(offset, length)), **level})
+        snap = copy.copy(self)
+        snap.stock_version = stock_version
+        snap._patched = patched
+        snap._bodies = self._bodies if patched == self._patched else {}
+        return snap
+
+
+def write_snapshot(directory: Path, version: int, stock_version: int, products: List[Dict[str, Any]],
+                   categories: List[Dict[str, Any]]) -> Path:
+    """Serialize products (ordered by id) into a new generation file and rename it into place"""
+    blobs = [catalog_cache.encode(p) for p in products]
+    groups: Dict[str, List[int]] = {}
+    for i, p in enumerate(products):
+        groups.setdefault(p["category"], []).append(i)
+
+    data = bytearray()
+
+    def write_group(indices: List[int]) -> List[int]:
+        body_start = len(data)
+        data.extend(b"[")
+        entries = []
+        for k, i in enumerate(indices):
+            if k:
+                data.extend(b",")
+            entries.append((products[i]["id"], len(data), len(blobs[i])))
+            data.extend(blobs[i])
+        data.extend(b"]")
+        body_len = len(data) - body_start
+        index_start = len(data)
+        for entry in entries:
+            data.extend(_ENTRY.pack(*entry))
+        return [body_start, body_len, index_start, len(entries)]
+
+    header: Dict[str, Any] = {
+        "version": version,
+        "stockVersion": stock_version,
+        "all": write_group(list(range(len(products)))),
+        "categories": {name: write_group(indices) for name, indices in groups.items()},
+    }
+    categories_blob = catalog_cache.encode(categories)
+    header["categoriesBody"] = [len(data), len(categories_blob)]
+    data.extend(categories_blob)
+
+    header_blob = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    path = directory / f"catalog-{version}.snap"
+    tmp = directory / f".catalog-{version}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(MAGIC)
+        f.write(_HEADER_LEN.pack(len(header_blob)))
+        f.write(header_blob)
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    return path
+
+
+def _remove_old_generations(directory: Path, version: int) -> None:
+    # Unlinking is safe while other workers still have an old file mapped
+    for old in directory.glob("catalog-*.snap"):
+        try:
+            if int(old.stem.split("-", 1)[1]) < version:
+                old.unlink()
+        except (ValueError, FileNotFoundError):
+            pass
+
+
+def _ensure_generation(db: Session, directory: Path, version: int, stock_version: int) -> Path:
+    # Generations are per catalog version only; stock bumps never write a file
+    path = directory / f"catalog-{version}.snap"
+    if path.exists():
+        return path
+    # Cross-process lock so a single worker builds each generation
+    with open(directory / ".build.lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            if path.exists():
+                return path
+            snap = catalog_cache.build_snapshot(db, version, stock_version)
+            path = write_snapshot(directory, version, stock_version, snap.products, snap.categories)
+            _remove_old_generations(directory, version)
+            logger.info(f"Built shared catalog snapshot {path.name} ({len(snap.products)} products)")
+            return path
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def get_shared_snapshot(db: Session, version: int, stock_version: int):
+    global _current
+    snap = _current
+    if snap is not None and snap.version == version and snap.stock_version == stock_version:
+        return snap
+    with _lock:
+        if _current is None or _current.version != version:
+            directory = Path(config.catalog_snapshot_dir)
+            directory.mkdir(parents=True, exist_ok=True)
+            # Swapping the reference is atomic; requests already holding the
+            # previous generation finish on it and its mapping is then released
+            try:
+                _current = SharedCatalogSnapshot(_ensure_generation(db, directory, version, stock_version))
+            except FileNotFoundError:
+                # A newer generation replaced this one between the check and the
+                # open; serve this request from a private copy instead
+                return catalog_cache.build_snapshot(db, version, stock_version)
+        if _current.stock_version != stock_version:
+            _current = _current.with_stock(db, stock_version)
+        return _current
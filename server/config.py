@@ -20,12 +20,34 @@ class Config:
     # Firebase (optional)
     firebase_credentials_json: str | None = os.getenv("FIREBASE_CREDENTIALS_JSON")
 
+    # Directory for the memory-mapped catalog snapshot shared by all workers
+    # (e.g. /dev/shm/grocery-catalog); unset keeps a per-process cache
+    catalog_snapshot_dir: str | None = os.getenv("CATALOG_SNAPSHOT_DIR")
+
+    # How long a checkout Idempotency-Key is remembered and replayed
+    idempotency_ttl_hours: int = int(os.getenv("IDEMPOTENCY_TTL_HOURS", "24"))
+
+    # Low-stock alerts: changes within this window are folded into one notification update
+    low_stock_alert_window_minutes: int = int(os.getenv("LOW_STOCK_ALERT_WINDOW_MINUTES", "15"))
+
+    # Job worker: how many jobs run at once (STK pushes overlap on the shared HTTP client)
+    job_concurrency: int = int(os.getenv("JOB_CONCURRENCY", "16"))
+
     # M-Pesa
     mpesa_base: str = os.getenv("MPESA_BASE", "https://sandbox.safaricom.co.ke")
     mpesa_consumer_key: str = os.getenv("MPESA_CONSUMER_KEY", "")
     mpesa_consumer_secret: str = os.getenv("MPESA_CONSUMER_SECRET", "")
     mpesa_shortcode: str = os.getenv("MPESA_SHORTCODE", "174379")
     mpesa_passkey: str = os.getenv("MPESA_PASSKEY", "")
+    mpesa_callback_url: str = os.getenv(
+        "MPESA_CALLBACK_URL", "https://tricksy-servantless-divina.ngrok-free.dev/api/mpesa/callback"
+    )
+    # File where workers share the cached OAuth token (e.g. /dev/shm/mpesa-token.json);
+    # unset keeps the cache per process
+    mpesa_token_cache_path: str | None = os.getenv("MPESA_TOKEN_CACHE_PATH")
+    # Payment reconciliation: parallel STK status queries and a cap on queries per second
+    mpesa_query_concurrency: int = int(os.getenv("MPESA_QUERY_CONCURRENCY", "20"))
+    mpesa_query_rate: float = float(os.getenv("MPESA_QUERY_RATE", "50"))
 
 
 config = Config()
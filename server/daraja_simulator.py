@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the Safaricom Daraja API, for load-testing payments.
+
+Implements the endpoints server/mpesa.py uses:
+
+    GET  /oauth/v1/generate
+    POST /mpesa/stkpush/v1/processrequest
+    POST /mpesa/stkpushquery/v1/query
+
+Each accepted STK push is settled after a random callback delay and the
+result is POSTed to the push's CallBackURL (or --callback-url). Latency,
+failure, decline and lost-callback rates are configurable. Point the
+backend and worker at it with:
+
+    cd server && python daraja_simulator.py --port 8090
+    MPESA_BASE=http://localhost:8090 \\
+    MPESA_CALLBACK_URL=http://localhost:5001/api/mpesa/callback python worker.py
+"""
+
+from __future__ import annotations
+
+import argparse
+import logging
+import random
+import threading
+import time
+import uuid
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+import httpx
+from flask import Flask, jsonify, request
+
+logger = logging.getLogger("daraja_simulator")
+
+PROCESSING_ERROR = {"errorCode": "500.001.1001", "errorMessage": "The transaction is being processed"}
+
+
+class Simulator:
+    def __init__(self, args: argparse.Namespace) -> None:
+        self.args = args
+        self._lock = threading.Lock()
+        # CheckoutRequestID -> settled result (None while the customer "decides")
+        self._pushes: Dict[str, Optional[Dict[str, Any]]] = {}
+        self._client = httpx.Client(timeout=10)
+        self.stats = {"tokens": 0, "pushes": 0, "push_errors": 0, "queries": 0, "callbacks": 0, "callbacks_dropped": 0}
+
+    def count(self, key: str) -> None:
+        with self._lock:
+            self.stats[key] += 1
+
+    def latency(self) -> None:
+        delay = max(0.0, random.gauss(self.args.latency_ms, self.args.jitter_ms)) / 1000
+        if delay:
+            time.sleep(delay)
+
+    def start_push(self, payload: Dict[str, Any]) -> str:
+        checkout_id = f"ws_CO_{datetime.utcnow():%d%m%Y%H%M%S}{uuid.uuid4().hex[:12]}"
+        with self._lock:
+            self._pushes[checkout_id] = None
+        delay = random.uniform(self.args.callback_min_delay, self.args.callback_max_delay)
+        timer = threading.Timer(delay, self._settle, args=(checkout_id, payload))
+        timer.daemon = True
+        timer.start()
+        return checkout_id
+
+    def _settle(self, checkout_id: str, payload: Dict[str, Any]) -> None:
+        if random.random() < self.args.decline_rate:
+            result = {"ResultCode": 1032, "ResultDesc": "Request cancelled by user"}
+        else:
+            result = {
+                "ResultCode": 0,
+                "ResultDesc": "The service request is processed successfully.",
+                "CallbackMetadata": {"Item": [
+                    {"Name": "Amount", "Value": payload.get("Amount")},
+                    {"Name": "MpesaReceiptNumber", "Value": f"SIM{uuid.uuid4().hex[:7].upper()}"},
+                    {"Name": "TransactionDate", "Value": int(f"{datetime.utcnow():%Y%m%d%H%M%S}")},
+                    {"Name": "PhoneNumber", "Value": int(payload.get("PhoneNumber") or 0)},
+                ]},
+            }
+        with self._lock:
+            self._pushes[checkout_id] = result
+
+        if random.random() < self.args.drop_callback_rate:
+            # Lost callback: only the STK query API will reveal the result
+            self.count("callbacks_dropped")
+            return
+        body = {"Body": {"stkCallback": {
+            "MerchantRequestID": f"sim-{checkout_id[-12:]}",
+            "CheckoutRequestID": checkout_id,
+            **result,
+        }}}
+        url = self.args.callback_url or payload.get("CallBackURL")
+        try:
+            self._client.post(url, json=body)
+            self.count("callbacks")
+        except httpx.HTTPError as e:
+            logger.warning(f"Callback to {url} failed: {e}")
+
+    def query(self, checkout_id: str) -> Optional[Dict[str, Any]]:
+        """Settled result, {} while pending, or None for unknown ids"""
+        with self._lock:
+            if checkout_id not in self._pushes:
+                return None
+            return self._pushes[checkout_id] or {}
+
+
+def create_app(sim: Simulator) -> Flask:
+    app = Flask(__name__)
+
+    @app.get("/oauth/v1/generate")
+    def generate_token():
+        sim.latency()
+        if not request.headers.get("Authorization", "").startswith("Basic "):
+            return jsonify({"errorCode": "400.008.01", "errorMessage": "Invalid Authentication passed"}), 400
+        sim.count("tokens")
+        return jsonify({"access_token": uuid.uuid4().hex, "expires_in": str(sim.args.token_ttl)})
+
+    @app.post("/mpesa/stkpush/v1/processrequest")
+    def process_request():
+        sim.latency()
+        if not request.headers.get("Authorization", "").startswith("Bearer "):
+            return jsonify({"errorCode": "404.001.03", "errorMessage": "Invalid Access Token"}), 401
+        if random.random() < sim.args.failure_rate:
+            sim.count("push_errors")
+            return jsonify({"requestId": uuid.uuid4().hex, "errorCode": "500.001.1001",
+                            "errorMessage": "Unable to lock subscriber, a transaction is already in process"}), 500
+
+        payload = request.get_json(force=True, silent=True) or {}
+        checkout_id = sim.start_push(payload)
+        sim.count("pushes")
+        return jsonify({
+            "MerchantRequestID": f"sim-{checkout_id[-12:]}",
+            "CheckoutRequestID": checkout_id,
+            "ResponseCode": "0",
+            "ResponseDescription": "Success. Request accepted for processing",
+            "CustomerMessage": "Success. Request accepted for processing",
+        })
+
+    @app.post("/mpesa/stkpushquery/v1/query")
+    def stk_query():
+        sim.latency()
+        sim.count("queries")
+        payload = request.get_json(force=True, silent=True) or {}
+        result = sim.query(payload.get("CheckoutRequestID", ""))
+        if result is None:
+            return jsonify({"errorCode": "400.002.02", "errorMessage": "Bad Request - Invalid CheckoutRequestID"}), 400
+        if not result:
+            return jsonify({"requestId": uuid.uuid4().hex, **PROCESSING_ERROR}), 500
+        return jsonify({
+            "ResponseCode": "0",
+            "ResponseDescription": "The service request has been accepted successsfully",
+            "MerchantRequestID": f"sim-{payload['CheckoutRequestID'][-12:]}",
+            "CheckoutRequestID": payload["CheckoutRequestID"],
+            "ResultCode": str(result["ResultCode"]),
+            "ResultDesc": result["ResultDesc"],
+        })
+
+    @app.get("/stats")
+    def stats():
+        return jsonify(sim.stats)
+
+    return app
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Local M-Pesa Daraja simulator")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--latency-ms", type=float, default=150, help="mean API response latency")
+    parser.add_argument("--jitter-ms", type=float, default=50, help="standard deviation of the latency")
+    parser.add_argument("--failure-rate", type=float, default=0.02, help="share of STK pushes rejected with a 500")
+    parser.add_argument("--decline-rate", type=float, default=0.1, help="share of pushes the customer cancels")
+    parser.add_argument("--drop-callback-rate", type=float, default=0.0, help="share of results never called back")
+    parser.add_argument("--callback-min-delay", type=float, default=2.0, help="seconds")
+    parser.add_argument("--callback-max-delay", type=float, default=8.0, help="seconds")
+    parser.add_argument("--callback-url", help="override the CallBackURL sent with each push")
+    parser.add_argument("--token-ttl", type=int, default=3599, help="expires_in of issued tokens")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    create_app(Simulator(args)).run(host="0.0.0.0", port=args.port, threaded=True)
+
+
+if __name__ == "__main__":
+    main()
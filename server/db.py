@@ -4,8 +4,9 @@ import os
 from datetime import datetime
 from typing import Optional
 
-from sqlalchemy import Boolean, DateTime, Float, Integer, String, Text, create_engine
-from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, sessionmaker
+from sqlalchemy import Boolean, DateTime, Float, Index, Integer, LargeBinary, String, Text, UniqueConstraint, create_engine, text
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import DeclarativeBase, Mapped, Session, mapped_column, sessionmaker
 from config import config
 
 engine = create_engine(config.database_url, echo=False, future=True)
@@ -16,6 +17,24 @@ class Base(DeclarativeBase):
     pass
 
 
+def dialect_insert(session: Session):
+    """INSERT construct supporting ON CONFLICT for the session's database"""
+    if session.get_bind().dialect.name == "postgresql":
+        return postgresql.insert
+    return sqlite.insert
+
+
+def begin_write(session: Session) -> None:
+    """
+    Open the session's transaction already holding the write lock. SQLite has no
+    row locks, so BEGIN IMMEDIATE stands in for SELECT ... FOR UPDATE; elsewhere
+    this is a no-op and callers lock rows with with_for_update(). Must run
+    before any other statement in the session.
+    """
+    if session.get_bind().dialect.name == "sqlite":
+        session.execute(text("BEGIN IMMEDIATE"))
+
+
 class User(Base):
     __tablename__ = "users"
 
@@ -48,18 +67,25 @@ class Product(Base):
     description: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
     price: Mapped[float] = mapped_column(Float, nullable=False)
     image: Mapped[str] = mapped_column(Text, nullable=False)
-    category: Mapped[str] = mapped_column(String(255), nullable=False)
+    category: Mapped[str] = mapped_column(String(255), nullable=False, index=True)
     size: Mapped[Optional[str]] = mapped_column(String(64), nullable=True)
     stock_quantity: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
     delivery_price: Mapped[Optional[float]] = mapped_column(Float, nullable=True)
     discount: Mapped[Optional[float]] = mapped_column(Float, nullable=True)
     in_stock: Mapped[bool] = mapped_column(Boolean, nullable=False, default=True)
+    reorder_threshold: Mapped[int] = mapped_column(Integer, nullable=False, default=5)  # low-stock alert level
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
     updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
 
 class Order(Base):
     __tablename__ = "orders"
+    __table_args__ = (
+        # total makes it covering for revenue aggregates on the analytics dashboard
+        Index("ix_orders_payment_status_created_at_total", "payment_status", "created_at", "total"),
+        Index("ix_orders_created_at", "created_at"),
+        Index("ix_orders_customer_phone", "customer_phone"),
+    )
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
     user_id: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
@@ -76,9 +102,29 @@ class Order(Base):
     payment_status: Mapped[str] = mapped_column(String(64), nullable=False, default="pending")
     order_status: Mapped[str] = mapped_column(String(64), nullable=False, default="processing")
     mpesa_transaction_id: Mapped[Optional[str]] = mapped_column(String(128), nullable=True)
+    checkout_request_id: Mapped[Optional[str]] = mapped_column(String(128), nullable=True, index=True)  # latest STK push
+    mpesa_receipt: Mapped[Optional[str]] = mapped_column(String(64), nullable=True, index=True)
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
 
 
+# Customer order history: newest first, keyset-paginated (see GET /api/orders)
+Index("ix_orders_user_id_created_at", Order.user_id, Order.created_at.desc(), Order.id)
+
+
+class OrderItem(Base):
+    """One line of an order, written with the order (Order.items keeps the JSON copy)"""
+    __tablename__ = "order_items"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    order_id: Mapped[int] = mapped_column(Integer, nullable=False, index=True)
+    product_id: Mapped[int] = mapped_column(Integer, nullable=False, index=True)
+    name: Mapped[str] = mapped_column(String(255), nullable=False)
+    image: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    unit_price: Mapped[float] = mapped_column(Float, nullable=False)
+    quantity: Mapped[int] = mapped_column(Integer, nullable=False)
+    line_total: Mapped[float] = mapped_column(Float, nullable=False)
+
+
 class DeliveryAddress(Base):
     __tablename__ = "delivery_addresses"
 
@@ -107,8 +153,21 @@ class Cart(Base):
     __tablename__ = "carts"
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
-    user_id: Mapped[int] = mapped_column(Integer, nullable=False)
-    items: Mapped[str] = mapped_column(Text, default="[]", nullable=False)  # JSON string
+    user_id: Mapped[int] = mapped_column(Integer, nullable=False, unique=True, index=True)
+    # Legacy JSON lines, superseded by cart_items; emptied once migrated
+    items: Mapped[str] = mapped_column(Text, default="[]", nullable=False)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+class CartItem(Base):
+    __tablename__ = "cart_items"
+    __table_args__ = (UniqueConstraint("cart_id", "product_id", name="uq_cart_items_cart_product"),)
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    cart_id: Mapped[int] = mapped_column(Integer, nullable=False)
+    product_id: Mapped[int] = mapped_column(Integer, nullable=False)
+    quantity: Mapped[int] = mapped_column(Integer, nullable=False)
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
     updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
@@ -123,3 +182,102 @@ class Notification(Base):
     type: Mapped[str] = mapped_column(String(50), nullable=False, default="info")
     read: Mapped[bool] = mapped_column(Boolean, default=False, nullable=False)
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+
+class LowStockAlert(Base):
+    """One row per product, reopened and updated in place as stock runs low again"""
+    __tablename__ = "low_stock_alerts"
+
+    product_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    status: Mapped[str] = mapped_column(String(16), nullable=False, default="open", index=True)  # open/resolved
+    stock_level: Mapped[int] = mapped_column(Integer, nullable=False)
+    threshold: Mapped[int] = mapped_column(Integer, nullable=False)
+    notification_id: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    opened_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    notified_at: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
+
+
+class DailySales(Base):
+    """Paid, uncancelled orders rolled up by the day they were placed (see sales_rollup.py)"""
+    __tablename__ = "daily_sales"
+
+    date: Mapped[str] = mapped_column(String(10), primary_key=True)  # YYYY-MM-DD
+    revenue: Mapped[float] = mapped_column(Float, nullable=False, default=0.0)
+    orders: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    items: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    # HyperLogLog registers over customer phones; estimate with sales_rollup.distinct_customers
+    distinct_customers_sketch: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
+
+
+class ProductDailySales(Base):
+    """Units and revenue per product per day, for the same orders as daily_sales"""
+    __tablename__ = "product_daily_sales"
+
+    date: Mapped[str] = mapped_column(String(10), primary_key=True)  # YYYY-MM-DD
+    product_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    units: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    revenue: Mapped[float] = mapped_column(Float, nullable=False, default=0.0)
+
+    __table_args__ = (Index("ix_product_daily_sales_product_id_date", "product_id", "date"),)
+
+
+class CatalogVersion(Base):
+    __tablename__ = "catalog_version"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    version: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+class IdempotencyKey(Base):
+    __tablename__ = "idempotency_keys"
+
+    # "<user id or anon>:<path>:<Idempotency-Key header>"
+    key: Mapped[str] = mapped_column(String(255), primary_key=True)
+    request_hash: Mapped[str] = mapped_column(String(64), nullable=False)
+    status_code: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)  # None while in progress
+    response_body: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    order_id: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, index=True)
+
+
+class Job(Base):
+    __tablename__ = "jobs"
+    __table_args__ = (Index("ix_jobs_status_run_at", "status", "run_at"),)
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    kind: Mapped[str] = mapped_column(String(64), nullable=False)
+    reference: Mapped[Optional[str]] = mapped_column(String(128), nullable=True, index=True)  # e.g. "order:42"
+    payload: Mapped[str] = mapped_column(Text, nullable=False, default="{}")  # JSON string
+    status: Mapped[str] = mapped_column(String(16), nullable=False, default="pending")  # pending/running/done/failed
+    attempts: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    max_attempts: Mapped[int] = mapped_column(Integer, nullable=False, default=5)
+    run_at: Mapped[datetime] = mapped_column(DateTime, nullable=False, default=datetime.utcnow)
+    locked_at: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
+    last_error: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+class StkRequest(Base):
+    """Every STK push sent for an order, so results for earlier prompts still find it"""
+    __tablename__ = "stk_requests"
+
+    checkout_request_id: Mapped[str] = mapped_column(String(128), primary_key=True)
+    order_id: Mapped[int] = mapped_column(Integer, nullable=False, index=True)
+    status: Mapped[str] = mapped_column(String(16), nullable=False, default="pending")  # pending/failed/succeeded
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (Index("ix_stk_requests_status_created_at", "status", "created_at"),)
+
+
+class MpesaCallback(Base):
+    """Append-only inbox of raw STK callbacks, applied to orders by the worker"""
+    __tablename__ = "mpesa_callbacks"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    checkout_request_id: Mapped[str] = mapped_column(String(128), nullable=False, index=True)
+    body: Mapped[str] = mapped_column(Text, nullable=False)  # raw JSON as received
+    received_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    processed_at: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True, index=True)
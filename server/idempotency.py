@@ -0,0 +1,111 @@
+from __future__ import annotations
+
+import hashlib
+import json
+from datetime import datetime, timedelta
+from functools import wraps
+from typing import Callable, Optional
+
+from flask import Response, current_app, jsonify, make_response, request, session
+from sqlalchemy import delete
+from sqlalchemy.orm import Session
+
+from config import config
+from db import IdempotencyKey, SessionLocal, dialect_insert
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+MAX_KEY_LENGTH = 128
+
+# A reservation with no stored response after this long belongs to a request
+# that died mid-flight; a retry may take it over.
+IN_PROGRESS_TIMEOUT = timedelta(minutes=2)
+
+
+def _request_hash() -> str:
+    payload = request.get_json(force=True, silent=True)
+    if payload is None:
+        raw = request.get_data()
+    else:
+        raw = json.dumps(payload, sort_keys=True, separators=(",", ":")).encode("utf-8")
+    return hashlib.sha256(raw).hexdigest()
+
+
+def _reserve(db: Session, key: str, request_hash: str) -> Optional[Response]:
+    """Claim the key for this request, or return the response a duplicate should get"""
+    now = datetime.utcnow()
+    expires_before = now - timedelta(hours=config.idempotency_ttl_hours)
+
+    row = db.get(IdempotencyKey, key)
+    if row is not None:
+        abandoned = row.status_code is None and row.created_at < now - IN_PROGRESS_TIMEOUT
+        if row.created_at < expires_before or abandoned:
+            db.delete(row)
+            db.flush()
+        elif row.request_hash != request_hash:
+            return make_response(jsonify({"message": "Idempotency-Key was already used for a different request"}), 422)
+        elif row.status_code is None:
+            return make_response(jsonify({"message": "A request with this Idempotency-Key is still being processed"}), 409)
+        else:
+            replay = current_app.response_class(row.response_body, status=row.status_code, mimetype="application/json")
+            replay.headers["Idempotent-Replayed"] = "true"
+            return replay
+
+    # Expired keys are swept here; created_at is indexed so this stays cheap
+    db.execute(delete(IdempotencyKey).where(IdempotencyKey.created_at < expires_before))
+    stmt = (
+        dialect_insert(db)(IdempotencyKey)
+        .values(key=key, request_hash=request_hash, created_at=now)
+        .on_conflict_do_nothing(index_elements=["key"])
+    )
+    if db.execute(stmt).rowcount == 0:
+        # A concurrent duplicate claimed it between our lookup and insert
+        db.rollback()
+        return make_response(jsonify({"message": "A request with this Idempotency-Key is still being processed"}), 409)
+    db.commit()
+    return None
+
+
+def _finish(key: str, response: Optional[Response]) -> None:
+    """Store a successful response, or release the key so a corrected retry can run"""
+    with SessionLocal() as db:
+        row = db.get(IdempotencyKey, key)
+        if row is None:
+            return
+        if response is None or response.status_code >= 300:
+            db.delete(row)
+        else:
+            row.status_code = response.status_code
+            row.response_body = response.get_data(as_text=True)
+            body = response.get_json(silent=True)
+            if isinstance(body, dict) and isinstance(body.get("id"), int):
+                row.order_id = body["id"]
+        db.commit()
+
+
+def idempotent(func: Callable):
+    """
+    Replay the stored response for requests repeating an Idempotency-Key header.
+    Keys are scoped to the user and path and remembered for IDEMPOTENCY_TTL_HOURS.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get(IDEMPOTENCY_HEADER, "").strip()
+        if not key:
+            return func(*args, **kwargs)
+        if len(key) > MAX_KEY_LENGTH:
+            return jsonify({"message": f"Idempotency-Key must be at most {MAX_KEY_LENGTH} characters"}), 400
+
+        scoped_key = f"{session.get('user_id') or 'anon'}:{request.path}:{key}"
+        with SessionLocal() as db:
+            duplicate = _reserve(db, scoped_key, _request_hash())
+        if duplicate is not None:
+            return duplicate
+
+        try:
+            response = make_response(func(*args, **kwargs))
+        except Exception:
+            _finish(scoped_key, None)
+            raise
+        _finish(scoped_key, response)
+        return response
+    return wrapper
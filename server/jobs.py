@@ -0,0 +1,192 @@
+"""
+Durable background jobs stored in the ``jobs`` table.
+
+Web handlers call ``enqueue`` inside their own transaction (outbox style),
+so a job exists exactly when the data it refers to was committed. A worker
+process (``python worker.py``) claims due jobs in batches, runs up to
+JOB_CONCURRENCY handlers at once and reschedules failures with
+exponential backoff until ``max_attempts`` is reached. The worker also
+runs tasks registered with ``periodic`` on a fixed interval.
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional, Set
+
+from sqlalchemy import or_, select, update
+from sqlalchemy.orm import Session
+
+from config import config
+from db import Job, SessionLocal
+
+logger = logging.getLogger(__name__)
+
+BACKOFF_BASE_SECONDS = 5
+BACKOFF_MAX_SECONDS = 300
+# A running job whose worker has not finished it within this window is
+# assumed dead and becomes claimable again
+LOCK_TIMEOUT = timedelta(minutes=5)
+
+JobHandler = Callable[[Dict[str, Any]], None]
+HANDLERS: Dict[str, JobHandler] = {}
+# Tasks the worker runs on a fixed interval: [func, interval seconds, next run (monotonic)]
+PERIODIC: List[List[Any]] = []
+
+
+class PermanentJobError(Exception):
+    """Raised by a handler when retrying cannot help (e.g. invalid input)"""
+
+
+def register(kind: str) -> Callable[[JobHandler], JobHandler]:
+    def decorator(func: JobHandler) -> JobHandler:
+        HANDLERS[kind] = func
+        return func
+    return decorator
+
+
+def periodic(interval: float) -> Callable[[Callable[[], Any]], Callable[[], Any]]:
+    def decorator(func: Callable[[], Any]) -> Callable[[], Any]:
+        PERIODIC.append([func, interval, 0.0])
+        return func
+    return decorator
+
+
+def run_periodic() -> None:
+    now = time.monotonic()
+    for task in PERIODIC:
+        func, interval, next_run = task
+        if now < next_run:
+            continue
+        task[2] = now + interval
+        try:
+            func()
+        except Exception as e:
+            logger.error(f"Periodic task {func.__name__} failed: {type(e).__name__} - {str(e)}")
+
+
+def enqueue(db: Session, kind: str, payload: Dict[str, Any], reference: Optional[str] = None,
+            max_attempts: int = 5) -> Job:
+    """Add a job to the caller's transaction; it becomes visible on commit"""
+    job = Job(
+        kind=kind,
+        reference=reference,
+        payload=json.dumps(payload),
+        status="pending",
+        max_attempts=max_attempts,
+        run_at=datetime.utcnow(),
+    )
+    db.add(job)
+    return job
+
+
+def latest_for(db: Session, reference: str) -> Optional[Job]:
+    return db.scalar(select(Job).where(Job.reference == reference).order_by(Job.id.desc()).limit(1))
+
+
+def _claim(db: Session, limit: int) -> List[int]:
+    """Claim up to limit due jobs; returns the ids this worker now owns"""
+    now = datetime.utcnow()
+    due = or_(
+        (Job.status == "pending") & (Job.run_at <= now),
+        (Job.status == "running") & (Job.locked_at < now - LOCK_TIMEOUT),
+    )
+    job_ids = list(db.scalars(select(Job.id).where(due).order_by(Job.run_at).limit(limit)))
+    if not job_ids:
+        return []
+    # Guarded update so two workers can't claim the same job
+    claimed = list(db.scalars(
+        update(Job)
+        .where(Job.id.in_(job_ids), due)
+        .values(status="running", locked_at=now, attempts=Job.attempts + 1)
+        .returning(Job.id)
+        .execution_options(synchronize_session=False)
+    ))
+    db.commit()
+    return claimed
+
+
+def _backoff(attempts: int) -> timedelta:
+    return timedelta(seconds=min(BACKOFF_BASE_SECONDS * 2 ** (attempts - 1), BACKOFF_MAX_SECONDS))
+
+
+def _run(job_id: int) -> None:
+    """Run a claimed job and record its outcome"""
+    with SessionLocal() as db:
+        job = db.get(Job, job_id)
+        kind, payload = job.kind, job.payload
+        # Hand the connection back while the handler runs; it opens its own sessions
+        db.commit()
+        handler = HANDLERS.get(kind)
+        try:
+            if handler is None:
+                raise PermanentJobError(f"No handler registered for job kind '{kind}'")
+            handler(json.loads(payload))
+        except PermanentJobError as e:
+            logger.error(f"Job {job.id} ({job.kind}) failed permanently: {e}")
+            job.status = "failed"
+            job.last_error = str(e)
+        except Exception as e:
+            job.last_error = f"{type(e).__name__}: {e}"
+            if job.attempts >= job.max_attempts:
+                logger.error(f"Job {job.id} ({job.kind}) gave up after {job.attempts} attempts: {e}")
+                job.status = "failed"
+            else:
+                delay = _backoff(job.attempts)
+                logger.warning(f"Job {job.id} ({job.kind}) attempt {job.attempts} failed, retrying in {delay}: {e}")
+                job.status = "pending"
+                job.run_at = datetime.utcnow() + delay
+        else:
+            job.status = "done"
+            job.last_error = None
+        job.locked_at = None
+        db.commit()
+
+
+def run_one() -> bool:
+    """Claim and run one due job. Returns False when nothing was due."""
+    with SessionLocal() as db:
+        claimed = _claim(db, 1)
+    if not claimed:
+        return False
+    _run(claimed[0])
+    return True
+
+
+def run_worker(poll_interval: float = 1.0, concurrency: Optional[int] = None) -> None:
+    """
+    Claim due jobs in batches and run up to `concurrency` at once on a thread
+    pool. Handlers such as the STK push wait on the shared mpesa event loop,
+    so their HTTP calls overlap. Periodic tasks run on this thread in between.
+    """
+    concurrency = max(1, concurrency or config.job_concurrency)
+    logger.info(f"Job worker started (handlers: {', '.join(sorted(HANDLERS)) or 'none'}, concurrency {concurrency})")
+    running: Set[Future] = set()
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="job") as pool:
+        while True:
+            run_periodic()
+            for future in [f for f in running if f.done()]:
+                running.discard(future)
+                e = future.exception()
+                if e is not None:
+                    logger.error(f"Job worker error: {type(e).__name__} - {str(e)}")
+
+            claimed: List[int] = []
+            if len(running) < concurrency:
+                try:
+                    with SessionLocal() as db:
+                        claimed = _claim(db, concurrency - len(running))
+                except Exception as e:
+                    logger.error(f"Job worker error: {type(e).__name__} - {str(e)}")
+            running.update(pool.submit(_run, job_id) for job_id in claimed)
+
+            if not claimed or len(running) >= concurrency:
+                # Wake up when a slot frees up, or poll for new jobs
+                if running:
+                    wait(running, timeout=poll_interval, return_when=FIRST_COMPLETED)
+                else:
+                    time.sleep(poll_interval)
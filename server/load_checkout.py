@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+End-to-end M-Pesa checkout load test against a running backend.
+
+Places ORDERS checkouts from CONCURRENCY threads and polls each order's
+payment status until it is paid (or --settle-timeout passes). Reports the
+checkout throughput plus p50/p95/p99 of the checkout request latency and
+of the full checkout-to-paid time. Run the backend and worker against
+daraja_simulator.py (see its docstring), then:
+
+    cd server && python load_checkout.py --orders 500 --concurrency 32
+"""
+
+from __future__ import annotations
+
+import argparse
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+
+_local = threading.local()
+
+
+def _client(base_url: str) -> httpx.Client:
+    client = getattr(_local, "client", None)
+    if client is None:
+        client = _local.client = httpx.Client(base_url=base_url, timeout=60)
+    return client
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    k = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[k]
+
+
+def pick_product(base_url: str, orders: int) -> int:
+    products = httpx.get(f"{base_url}/api/products", timeout=30).json()
+    best = max(products, key=lambda p: p.get("stockQuantity", 0), default=None)
+    if best is None:
+        sys.exit("No products found; seed the catalog first")
+    if best["stockQuantity"] < orders:
+        print(f"warning: product {best['id']} has only {best['stockQuantity']} in stock for {orders} orders")
+    return best["id"]
+
+
+def run_checkout(args: argparse.Namespace, product_id: int, n: int) -> Tuple[str, float, Optional[float]]:
+    """Returns (outcome, checkout latency, checkout-to-paid time or None)"""
+    client = _client(args.base_url)
+    start = time.perf_counter()
+    r = client.post("/api/orders", json={
+        "items": [{"id": product_id, "quantity": 1}],
+        "customerName": f"Load {n}",
+        "customerPhone": f"07{n % 100000000:08d}",
+        "deliveryAddress": "Nairobi",
+        "paymentMethod": "mpesa",
+    })
+    checkout_latency = time.perf_counter() - start
+    if r.status_code != 200:
+        return f"checkout_{r.status_code}", checkout_latency, None
+
+    order_id = r.json()["id"]
+    deadline = start + args.settle_timeout
+    while time.perf_counter() < deadline:
+        time.sleep(args.poll_interval)
+        status = client.get(f"/api/orders/{order_id}/payment-status").json()
+        if status.get("paymentStatus") == "completed":
+            return "paid", checkout_latency, time.perf_counter() - start
+        if status.get("stkPushStatus") == "failed":
+            return "push_failed", checkout_latency, None
+    return "unpaid", checkout_latency, None
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="M-Pesa checkout load test")
+    parser.add_argument("--base-url", default="http://localhost:5001")
+    parser.add_argument("--orders", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--product-id", type=int, help="defaults to the product with the most stock")
+    parser.add_argument("--settle-timeout", type=float, default=60, help="seconds to wait for each payment")
+    parser.add_argument("--poll-interval", type=float, default=0.5)
+    args = parser.parse_args()
+
+    product_id = args.product_id or pick_product(args.base_url, args.orders)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = list(pool.map(lambda n: run_checkout(args, product_id, n), range(args.orders)))
+    elapsed = time.perf_counter() - start
+
+    outcomes = Counter(outcome for outcome, _, _ in results)
+    checkout_ms = [latency * 1000 for _, latency, _ in results]
+    paid_ms = [settled * 1000 for _, _, settled in results if settled is not None]
+    accepted = sum(n for outcome, n in outcomes.items() if not outcome.startswith("checkout_"))
+
+    summary: Dict[str, List[float]] = {"checkout request": checkout_ms, "checkout to paid": paid_ms}
+    print(f"{args.orders} checkouts on {args.concurrency} threads in {elapsed:.1f}s: {dict(outcomes)}")
+    print(f"checkout throughput {accepted / elapsed:.1f} orders/s, {len(paid_ms) / elapsed:.1f} paid/s end to end")
+    for label, values in summary.items():
+        print(
+            f"{label:>16}: p50 {percentile(values, 50):8.1f} ms  p95 {percentile(values, 95):8.1f} ms  "
+            f"p99 {percentile(values, 99):8.1f} ms  (n={len(values)})"
+        )
+    return 0 if accepted else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
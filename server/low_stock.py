@@ -0,0 +1,108 @@
+"""
+Low-stock alerts.
+
+Checkout records products that fell to their reorder threshold with one
+upsert into ``low_stock_alerts`` (a single row per product). The job
+worker turns open alerts into admin notifications: each product owns one
+Notification that is rewritten in place, at most once per
+LOW_STOCK_ALERT_WINDOW_MINUTES, and alerts close once stock is back above
+the threshold.
+"""
+
+from __future__ import annotations
+
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, Tuple
+
+from sqlalchemy import case, or_, select, update
+from sqlalchemy.orm import Session
+
+import jobs
+from config import config
+from db import LowStockAlert, Notification, Product, SessionLocal, dialect_insert
+
+logger = logging.getLogger(__name__)
+
+SYNC_INTERVAL_SECONDS = 30
+DEFAULT_REORDER_THRESHOLD = 5  # matches the Product.reorder_threshold column default
+
+
+def record_low_stock(db: Session, levels: Dict[int, Tuple[int, int]]) -> None:
+    """
+    Open or refresh alerts for {product_id: (stock left, threshold)} in the
+    caller's transaction, as one executemany upsert.
+    """
+    if not levels:
+        return
+    now = datetime.utcnow()
+    stmt = dialect_insert(db)(LowStockAlert)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["product_id"],
+        set_={
+            "stock_level": stmt.excluded.stock_level,
+            "threshold": stmt.excluded.threshold,
+            "updated_at": stmt.excluded.updated_at,
+            "opened_at": case((LowStockAlert.status == "resolved", stmt.excluded.opened_at), else_=LowStockAlert.opened_at),
+            "status": "open",
+        },
+    )
+    db.execute(stmt, [
+        {"product_id": pid, "stock_level": stock, "threshold": threshold, "status": "open",
+         "opened_at": now, "updated_at": now}
+        for pid, (stock, threshold) in levels.items()
+    ])
+
+
+def _message(name: str, stock_level: int) -> str:
+    return f"Product '{name}' is low on stock ({stock_level} remaining). Please reorder."
+
+
+@jobs.periodic(SYNC_INTERVAL_SECONDS)
+def sync_alert_notifications() -> int:
+    """Publish changed alerts as notifications and close recovered ones. Returns notifications written."""
+    now = datetime.utcnow()
+    window_start = now - timedelta(minutes=config.low_stock_alert_window_minutes)
+    with SessionLocal() as db:
+        # Restocked (by an admin, or by cancelled orders) above the threshold
+        recovered = select(Product.id).where(Product.stock_quantity > Product.reorder_threshold)
+        db.execute(
+            update(LowStockAlert)
+            .where(LowStockAlert.status == "open", LowStockAlert.product_id.in_(recovered))
+            .values(status="resolved")
+            .execution_options(synchronize_session=False)
+        )
+
+        due = db.execute(
+            select(LowStockAlert, Product.name)
+            .join(Product, Product.id == LowStockAlert.product_id)
+            .where(
+                LowStockAlert.status == "open",
+                or_(
+                    LowStockAlert.notified_at.is_(None),
+                    LowStockAlert.opened_at > LowStockAlert.notified_at,
+                    (LowStockAlert.updated_at > LowStockAlert.notified_at) & (LowStockAlert.notified_at <= window_start),
+                ),
+            )
+        ).all()
+        notifications = {}
+        ids = [alert.notification_id for alert, _ in due if alert.notification_id]
+        if ids:
+            notifications = {n.id: n for n in db.scalars(select(Notification).where(Notification.id.in_(ids)))}
+
+        for alert, name in due:
+            notification = notifications.get(alert.notification_id)
+            if notification is None:
+                notification = Notification(title="Low Stock Alert", type="warning", user_id=None, message="")
+                db.add(notification)
+            notification.message = _message(name, alert.stock_level)
+            notification.read = False
+            notification.created_at = now  # resurface the existing row instead of adding another
+            db.flush()
+            alert.notification_id = notification.id
+            alert.notified_at = now
+        db.commit()
+
+    if due:
+        logger.info(f"Published {len(due)} low-stock alerts")
+    return len(due)
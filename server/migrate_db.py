@@ -3,8 +3,16 @@ from __future__ import annotations
 import sqlite3
 from pathlib import Path
 
+from sqlalchemy import select
+
+import sales_rollup
 from config import config
-from db import Base, engine, DeliveryAddress, PaymentMethod, Cart, Notification
+from order_items import backfill_order_items
+from routes_cart import migrate_legacy_items
+from db import (
+    Base, engine, SessionLocal, DeliveryAddress, PaymentMethod, Cart, CartItem, Notification, OrderItem,
+    LowStockAlert, DailySales, ProductDailySales, StkRequest,
+)
 
 # Get database path
 db_path = config.database_url.replace("sqlite:///", "")
@@ -30,6 +38,66 @@ def migrate():
         else:
             print("✓ user_id column already exists")
         
+        # Dedicated, indexed M-Pesa lookup columns instead of the overloaded mpesa_transaction_id
+        for column, ddl in (("checkout_request_id", "VARCHAR(128)"), ("mpesa_receipt", "VARCHAR(64)")):
+            if column not in columns:
+                print(f"Adding {column} column to orders table...")
+                cursor.execute(f"ALTER TABLE orders ADD COLUMN {column} {ddl}")
+                conn.commit()
+                print(f"✓ Added {column} column")
+            else:
+                print(f"✓ {column} column already exists")
+        cursor.execute(
+            "UPDATE orders SET checkout_request_id = substr(mpesa_transaction_id, 5), mpesa_transaction_id = NULL "
+            "WHERE checkout_request_id IS NULL AND mpesa_transaction_id LIKE 'REQ:%'"
+        )
+        moved_requests = cursor.rowcount
+        cursor.execute(
+            "UPDATE orders SET mpesa_receipt = mpesa_transaction_id "
+            "WHERE mpesa_receipt IS NULL AND mpesa_transaction_id IS NOT NULL AND mpesa_transaction_id NOT LIKE 'REQ:%'"
+        )
+        moved_receipts = cursor.rowcount
+        cursor.execute("CREATE INDEX IF NOT EXISTS ix_orders_checkout_request_id ON orders (checkout_request_id)")
+        # Every push is kept in stk_requests; seed it with the latest push per order
+        conn.commit()
+        Base.metadata.create_all(engine, tables=[StkRequest.__table__])
+        cursor.execute(
+            "INSERT OR IGNORE INTO stk_requests (checkout_request_id, order_id, status, created_at) "
+            "SELECT checkout_request_id, id, 'pending', created_at FROM orders WHERE checkout_request_id IS NOT NULL"
+        )
+        cursor.execute("CREATE INDEX IF NOT EXISTS ix_orders_mpesa_receipt ON orders (mpesa_receipt)")
+        # Customer order history (GET /api/orders), newest first
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS ix_orders_user_id_created_at ON orders (user_id, created_at DESC, id)"
+        )
+        # Used by payment reconciliation to find stale pending orders, and
+        # covering for the analytics dashboard's revenue aggregates
+        cursor.execute("DROP INDEX IF EXISTS ix_orders_payment_status_created_at")
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS ix_orders_payment_status_created_at_total "
+            "ON orders (payment_status, created_at, total)"
+        )
+        # Recent orders and distinct customers on the analytics dashboard
+        cursor.execute("CREATE INDEX IF NOT EXISTS ix_orders_created_at ON orders (created_at)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS ix_orders_customer_phone ON orders (customer_phone)")
+        conn.commit()
+        print(f"✓ Backfilled {moved_requests} checkout request ids and {moved_receipts} M-Pesa receipts")
+        
+        print("Creating order_items table...")
+        Base.metadata.create_all(engine, tables=[OrderItem.__table__])
+        print("✓ order_items table ready")
+        
+        # Backfill order_items from the JSON items of orders that have no lines yet
+        cursor.execute(
+            "SELECT id FROM orders WHERE NOT EXISTS "
+            "(SELECT 1 FROM order_items WHERE order_items.order_id = orders.id)"
+        )
+        legacy_orders = [row[0] for row in cursor.fetchall()]
+        with SessionLocal() as db:
+            backfill_order_items(db, legacy_orders)
+            db.commit()
+        print(f"✓ Backfilled order_items for {len(legacy_orders)} orders")
+        
         # Create new tables if they don't exist
         print("Creating delivery_addresses table...")
         Base.metadata.create_all(engine, tables=[DeliveryAddress.__table__])
@@ -67,6 +135,19 @@ def migrate():
         else:
             print("✓ discount column already exists")
         
+        if "reorder_threshold" not in product_columns:
+            print("Adding reorder_threshold column to products table...")
+            cursor.execute("ALTER TABLE products ADD COLUMN reorder_threshold INTEGER NOT NULL DEFAULT 5")
+            conn.commit()
+            print("✓ Added reorder_threshold column")
+        else:
+            print("✓ reorder_threshold column already exists")
+        
+        # Index the category filter used by GET /api/products
+        cursor.execute("CREATE INDEX IF NOT EXISTS ix_products_category ON products (category)")
+        conn.commit()
+        print("✓ products.category index ready")
+        
         # Add loyalty fields to users
         cursor.execute("PRAGMA table_info(users)")
         user_columns = [col[1] for col in cursor.fetchall()]
@@ -100,10 +181,57 @@ def migrate():
         Base.metadata.create_all(engine, tables=[Cart.__table__])
         print("✓ carts table ready")
         
+        print("Creating cart_items table...")
+        Base.metadata.create_all(engine, tables=[CartItem.__table__])
+        print("✓ cart_items table ready")
+        
+        # Backfill cart_items from the legacy JSON column, then empty it
+        with SessionLocal() as db:
+            legacy_carts = list(db.scalars(select(Cart).where(Cart.items.isnot(None), Cart.items != "[]")))
+            for cart in legacy_carts:
+                migrate_legacy_items(db, cart)
+            db.commit()
+        print(f"✓ Backfilled cart_items for {len(legacy_carts)} carts")
+        
+        # One cart per user: fold duplicate carts into the oldest one, then enforce it
+        cursor.execute("SELECT user_id, MIN(id) FROM carts GROUP BY user_id HAVING COUNT(*) > 1")
+        duplicates = cursor.fetchall()
+        for user_id, keep_id in duplicates:
+            cursor.execute(
+                "INSERT INTO cart_items (cart_id, product_id, quantity, created_at, updated_at) "
+                "SELECT ?, product_id, quantity, created_at, updated_at FROM cart_items "
+                "WHERE cart_id IN (SELECT id FROM carts WHERE user_id = ? AND id != ?) "
+                "ON CONFLICT (cart_id, product_id) DO UPDATE SET quantity = max(quantity, excluded.quantity)",
+                (keep_id, user_id, keep_id),
+            )
+            cursor.execute(
+                "DELETE FROM cart_items WHERE cart_id IN (SELECT id FROM carts WHERE user_id = ? AND id != ?)",
+                (user_id, keep_id),
+            )
+            cursor.execute("DELETE FROM carts WHERE user_id = ? AND id != ?", (user_id, keep_id))
+        cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS ix_carts_user_id ON carts (user_id)")
+        conn.commit()
+        print(f"✓ carts.user_id unique index ready (merged {len(duplicates)} duplicate carts)")
+        
         print("Creating notifications table...")
         Base.metadata.create_all(engine, tables=[Notification.__table__])
         print("✓ notifications table ready")
         
+        print("Creating low_stock_alerts table...")
+        Base.metadata.create_all(engine, tables=[LowStockAlert.__table__])
+        print("✓ low_stock_alerts table ready")
+        
+        print("Creating daily_sales and product_daily_sales tables...")
+        Base.metadata.create_all(engine, tables=[DailySales.__table__, ProductDailySales.__table__])
+        cursor.execute("SELECT (SELECT COUNT(*) FROM daily_sales), (SELECT COUNT(*) FROM product_daily_sales)")
+        if 0 in cursor.fetchone():
+            with SessionLocal() as db:
+                days = sales_rollup.rebuild(db)
+                db.commit()
+            print(f"✓ sales rollup tables ready (backfilled {days} days)")
+        else:
+            print("✓ sales rollup tables ready")
+        
         print("\n✓ Database migration completed successfully!")
         
     except Exception as e:
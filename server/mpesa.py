@@ -1,40 +1,196 @@
 from __future__ import annotations
 
+import asyncio
+import atexit
 import base64
+import fcntl
+import hashlib
+import json
 import logging
+import os
+import threading
+import time
+from concurrent.futures import Future
 from datetime import datetime
-from typing import Any, Dict
+from typing import Any, Awaitable, Dict, Optional, Tuple, TypeVar
 
 import httpx
 from config import config
 
 logger = logging.getLogger(__name__)
 
+T = TypeVar("T")
 
-async def get_access_token() -> str:
-    """Get M-Pesa access token for API authentication"""
+# Keep-alive pool shared by every Daraja call in this process
+HTTP_LIMITS = httpx.Limits(max_connections=20, max_keepalive_connections=10, keepalive_expiry=60)
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_pid: Optional[int] = None
+_loop_lock = threading.Lock()
+_client: Optional[httpx.AsyncClient] = None
+
+# Refresh the OAuth token this long before Daraja says it expires
+TOKEN_EXPIRY_MARGIN_SECONDS = 60
+_token: Optional[Tuple[str, float]] = None  # (access token, expires at epoch seconds)
+_token_lock: Optional[asyncio.Lock] = None
+
+
+def _event_loop() -> asyncio.AbstractEventLoop:
+    """Start (once per process) the background thread that runs all M-Pesa I/O"""
+    global _loop, _loop_pid, _client, _token_lock
+    with _loop_lock:
+        # A forked worker inherits the variables but not the thread
+        if _loop is None or _loop_pid != os.getpid():
+            _loop = asyncio.new_event_loop()
+            _loop_pid = os.getpid()
+            _client = None
+            _token_lock = None
+            threading.Thread(target=_loop.run_forever, name="mpesa-event-loop", daemon=True).start()
+        return _loop
+
+
+def submit(coro: Awaitable[T]) -> "Future[T]":
+    """
+    Schedule a coroutine on the shared M-Pesa event loop. Returns a
+    concurrent.futures.Future; call .result(timeout) to wait for it.
+    """
+    return asyncio.run_coroutine_threadsafe(coro, _event_loop())
+
+
+def _http_client() -> httpx.AsyncClient:
+    """Pooled client bound to the background loop; only call from coroutines running there"""
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(limits=HTTP_LIMITS, timeout=30)
+    return _client
+
+
+@atexit.register
+def _shutdown() -> None:
+    loop = _loop
+    if loop is None or _loop_pid != os.getpid() or not loop.is_running():
+        return
+    if _client is not None:
+        try:
+            asyncio.run_coroutine_threadsafe(_client.aclose(), loop).result(timeout=5)
+        except Exception:
+            pass
+    loop.call_soon_threadsafe(loop.stop)
+
+
+def _credentials_id() -> str:
+    """Identifies the app a cached token belongs to, without storing the secret"""
+    return hashlib.sha256(f"{config.mpesa_base}|{config.mpesa_consumer_key}".encode()).hexdigest()[:16]
+
+
+def _usable(token: Optional[Tuple[str, float]]) -> Optional[str]:
+    if token and token[1] - TOKEN_EXPIRY_MARGIN_SECONDS > time.time():
+        return token[0]
+    return None
+
+
+def _read_shared_token() -> Optional[Tuple[str, float]]:
+    path = config.mpesa_token_cache_path
+    if not path:
+        return None
+    try:
+        with open(path) as f:
+            data = json.load(f)
+        if data.get("credentials") == _credentials_id():
+            return data["access_token"], float(data["expires_at"])
+    except (OSError, ValueError, KeyError):
+        pass
+    return None
+
+
+def _write_shared_token(token: Tuple[str, float]) -> None:
+    path = config.mpesa_token_cache_path
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump({"credentials": _credentials_id(), "access_token": token[0], "expires_at": token[1]}, f)
+        os.replace(tmp, path)
+    except OSError as e:
+        logger.warning(f"Could not store M-Pesa token in {path}: {e}")
+
+
+async def _request_access_token() -> Tuple[str, float]:
     try:
         logger.debug("Requesting M-Pesa access token")
         cred = base64.b64encode(f"{config.mpesa_consumer_key}:{config.mpesa_consumer_secret}".encode()).decode()
-        async with httpx.AsyncClient() as client:
-            r = await client.get(
-                f"{config.mpesa_base}/oauth/v1/generate?grant_type=client_credentials",
-                headers={"Authorization": f"Basic {cred}"},
-                timeout=15,
-            )
-            
-            if r.status_code != 200:
-                logger.error(f"Failed to get access token: {r.status_code} - {r.text}")
-                r.raise_for_status()
-            
-            token = r.json()["access_token"]
-            logger.debug("Access token obtained successfully")
-            return token
+        r = await _http_client().get(
+            f"{config.mpesa_base}/oauth/v1/generate?grant_type=client_credentials",
+            headers={"Authorization": f"Basic {cred}"},
+            timeout=15,
+        )
+
+        if r.status_code != 200:
+            logger.error(f"Failed to get access token: {r.status_code} - {r.text}")
+            r.raise_for_status()
+
+        body = r.json()
+        expires_at = time.time() + int(body.get("expires_in", 3599))
+        logger.debug("Access token obtained successfully")
+        return body["access_token"], expires_at
     except Exception as e:
         logger.error(f"Error getting access token: {type(e).__name__} - {str(e)}")
         raise
 
 
+async def _refresh_shared_token() -> Tuple[str, float]:
+    """Fetch a token while holding the cross-process lock, so only one worker calls Daraja"""
+    loop = asyncio.get_running_loop()
+    lock_fd = os.open(f"{config.mpesa_token_cache_path}.lock", os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        await loop.run_in_executor(None, fcntl.flock, lock_fd, fcntl.LOCK_EX)
+        token = _read_shared_token()
+        if _usable(token):
+            return token
+        token = await _request_access_token()
+        _write_shared_token(token)
+        return token
+    finally:
+        os.close(lock_fd)
+
+
+async def get_access_token() -> str:
+    """
+    Get M-Pesa access token for API authentication. Tokens are cached until
+    shortly before they expire; concurrent callers share a single refresh.
+    """
+    global _token, _token_lock
+    cached = _usable(_token)
+    if cached:
+        return cached
+
+    if _token_lock is None:
+        _token_lock = asyncio.Lock()
+    async with _token_lock:
+        cached = _usable(_token)
+        if cached:
+            return cached
+        if config.mpesa_token_cache_path:
+            shared = _read_shared_token()
+            _token = shared if _usable(shared) else await _refresh_shared_token()
+        else:
+            _token = await _request_access_token()
+        return _token[0]
+
+
+def invalidate_access_token(rejected: str) -> None:
+    """Drop a cached token Daraja rejected, unless it was already replaced"""
+    global _token
+    if _token and _token[0] == rejected:
+        _token = None
+    shared = _read_shared_token()
+    if shared and shared[0] == rejected:
+        try:
+            os.unlink(config.mpesa_token_cache_path)
+        except OSError:
+            pass
+
+
 async def initiate_stk_push(order_id: str, phone_number: str, amount: float) -> Dict[str, Any]:
     """
     Initiate M-Pesa STK push for payment
@@ -73,32 +229,73 @@ async def initiate_stk_push(order_id: str, phone_number: str, amount: float) ->
             "PartyA": phone_number,
             "PartyB": config.mpesa_shortcode,
             "PhoneNumber": phone_number,
-            "CallBackURL": "https://tricksy-servantless-divina.ngrok-free.dev/api/mpesa/callback",
+            "CallBackURL": config.mpesa_callback_url,
             "AccountReference": str(order_id),
             "TransactionDesc": f"Payment for order {order_id}",
         }
 
         logger.debug(f"STK push payload for order {order_id}: {payload}")
 
-        async with httpx.AsyncClient() as client:
-            r = await client.post(
-                f"{config.mpesa_base}/mpesa/stkpush/v1/processrequest",
-                json=payload,
-                headers={"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"},
-                timeout=30,
-            )
-            
-            if r.status_code != 200:
-                logger.error(f"STK push failed for order {order_id}: {r.status_code} - {r.text}")
-                r.raise_for_status()
-            
-            response = r.json()
-            logger.info(f"STK push successful for order {order_id}: {response}")
-            return response
-            
+        r = await _http_client().post(
+            f"{config.mpesa_base}/mpesa/stkpush/v1/processrequest",
+            json=payload,
+            headers={"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"},
+            timeout=30,
+        )
+
+        if r.status_code != 200:
+            logger.error(f"STK push failed for order {order_id}: {r.status_code} - {r.text}")
+            if r.status_code == 401:
+                # Token revoked or expired early; the next attempt fetches a new one
+                invalidate_access_token(access_token)
+            r.raise_for_status()
+
+        response = r.json()
+        logger.info(f"STK push successful for order {order_id}: {response}")
+        return response
+
     except ValueError as ve:
         logger.error(f"Validation error for order {order_id}: {str(ve)}")
         raise
     except Exception as e:
         logger.error(f"STK push error for order {order_id}: {type(e).__name__} - {str(e)}")
         raise
+
+
+async def query_stk_status(checkout_request_id: str) -> Dict[str, Any]:
+    """
+    Ask Daraja for the outcome of an STK push (STK Push Query API).
+
+    Returns the response body. A push the customer has not answered yet
+    comes back as an errorCode body instead of a ResultCode.
+    """
+    access_token = await get_access_token()
+    timestamp = datetime.utcnow().strftime("%Y%m%d%H%M%S")
+    password = base64.b64encode(f"{config.mpesa_shortcode}{config.mpesa_passkey}{timestamp}".encode()).decode()
+
+    r = await _http_client().post(
+        f"{config.mpesa_base}/mpesa/stkpushquery/v1/query",
+        json={
+            "BusinessShortCode": config.mpesa_shortcode,
+            "Password": password,
+            "Timestamp": timestamp,
+            "CheckoutRequestID": checkout_request_id,
+        },
+        headers={"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"},
+        timeout=15,
+    )
+
+    if r.status_code == 401:
+        invalidate_access_token(access_token)
+        r.raise_for_status()
+    if r.status_code != 200:
+        # "The transaction is being processed" is reported as an error body
+        try:
+            body = r.json()
+        except ValueError:
+            body = None
+        if isinstance(body, dict) and body.get("errorCode"):
+            return body
+        logger.error(f"STK query failed for {checkout_request_id}: {r.status_code} - {r.text}")
+        r.raise_for_status()
+    return r.json()
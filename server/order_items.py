@@ -0,0 +1,158 @@
+"""
+Order lines stored in the ``order_items`` table.
+
+Orders still keep their JSON ``items`` copy for older clients; everything
+that reads lines server-side (admin listings, cancellation, analytics)
+goes through the indexed table instead.
+"""
+
+from __future__ import annotations
+
+import json
+from typing import Any, Dict, Iterable, List, Sequence
+
+from sqlalchemy import ColumnElement, func, insert, select, update
+from sqlalchemy.orm import Session
+
+import catalog_cache
+import sales_rollup
+from db import Order, OrderItem, Product
+
+BACKFILL_CHUNK = 500  # orders per backfill query, well under SQLite's bound-parameter limit
+
+
+def add_order_items(db: Session, order_id: int, lines: List[Dict[str, Any]]) -> None:
+    """Insert an order's confirmed lines in the caller's transaction (one executemany)"""
+    if not lines:
+        return
+    db.execute(insert(OrderItem), [
+        {
+            "order_id": order_id,
+            "product_id": line["id"],
+            "name": line["name"],
+            "image": line.get("image"),
+            "unit_price": line["price"],
+            "quantity": line["quantity"],
+            "line_total": line["total"],
+        }
+        for line in lines
+    ])
+
+
+def serialize_order_item(item: OrderItem) -> Dict[str, Any]:
+    """Same shape as the entries of the legacy Order.items JSON"""
+    return {
+        "id": item.product_id,
+        "name": item.name,
+        "price": item.unit_price,
+        "quantity": item.quantity,
+        "image": item.image,
+        "total": item.line_total,
+    }
+
+
+def items_for_orders(db: Session, orders: Iterable[Order]) -> Dict[int, List[Dict[str, Any]]]:
+    """Lines for many orders in one query, keyed by order id"""
+    orders = list(orders)
+    lines: Dict[int, List[Dict[str, Any]]] = {o.id: [] for o in orders}
+    if not orders:
+        return lines
+    for item in db.scalars(
+        select(OrderItem).where(OrderItem.order_id.in_(list(lines))).order_by(OrderItem.order_id, OrderItem.id)
+    ):
+        lines[item.order_id].append(serialize_order_item(item))
+
+    # Orders placed before order_items existed and not yet backfilled by migrate_db.py
+    for o in orders:
+        if not lines[o.id] and o.items and o.items != "[]":
+            try:
+                lines[o.id] = json.loads(o.items) if isinstance(o.items, str) else o.items
+            except ValueError:
+                pass
+    return lines
+
+
+def _json_lines(order_id: int, raw_items: Any) -> List[Dict[str, Any]]:
+    """order_items rows from an order's JSON items, skipping malformed entries"""
+    try:
+        items = json.loads(raw_items or "[]") if isinstance(raw_items, str) else (raw_items or [])
+    except ValueError:
+        return []
+    rows = []
+    for item in items:
+        try:
+            quantity = int(item.get("quantity", 0))
+            price = float(item.get("price", 0))
+            rows.append({
+                "order_id": order_id,
+                "product_id": int(item.get("id")),
+                "name": item.get("name") or "",
+                "image": item.get("image"),
+                "unit_price": price,
+                "quantity": quantity,
+                "line_total": float(item.get("total", price * quantity)),
+            })
+        except (TypeError, ValueError, AttributeError):
+            continue
+    return rows
+
+
+def backfill_order_items(db: Session, order_ids: Sequence[int]) -> None:
+    """Write lines from the JSON items for any of the orders that have none yet, in the caller's transaction"""
+    for start in range(0, len(order_ids), BACKFILL_CHUNK):
+        chunk = order_ids[start:start + BACKFILL_CHUNK]
+        with_lines = set(db.scalars(select(OrderItem.order_id).where(OrderItem.order_id.in_(chunk)).distinct()))
+        missing = [order_id for order_id in chunk if order_id not in with_lines]
+        if not missing:
+            continue
+        rows = [
+            line
+            for order_id, raw_items in db.execute(select(Order.id, Order.items).where(Order.id.in_(missing)))
+            for line in _json_lines(order_id, raw_items)
+        ]
+        if rows:
+            db.execute(insert(OrderItem), rows)
+
+
+def restore_stock(db: Session, order_ids: Sequence[int]) -> None:
+    """Put the stock of the given orders back with one set-based UPDATE"""
+    if not order_ids:
+        return
+    # Orders placed before order_items existed and not yet backfilled by migrate_db.py
+    backfill_order_items(db, order_ids)
+    restored = (
+        select(func.sum(OrderItem.quantity))
+        .where(OrderItem.order_id.in_(order_ids), OrderItem.product_id == Product.id)
+        .scalar_subquery()
+    )
+    db.execute(
+        update(Product)
+        .where(Product.id.in_(select(OrderItem.product_id).where(OrderItem.order_id.in_(order_ids))))
+        .values(stock_quantity=Product.stock_quantity + restored, in_stock=(Product.stock_quantity + restored) > 0)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def cancel_orders(db: Session, criteria: Sequence[ColumnElement[bool]], **values: Any) -> List[int]:
+    """
+    Cancel the orders matching criteria, restore their stock and update the
+    sales rollup, in the caller's transaction. The status change is a guarded UPDATE ... RETURNING,
+    so an order already cancelled (e.g. by a concurrent or replayed request)
+    is skipped and its stock is never restored twice. Returns the ids that
+    were cancelled by this call; the round trips don't depend on how many.
+    """
+    rows = db.execute(
+        update(Order)
+        .where(Order.order_status != "cancelled", *criteria)
+        .values(order_status="cancelled", **values)
+        .returning(Order.id, Order.payment_status)
+        .execution_options(synchronize_session=False)
+    ).all()
+    cancelled = [row.id for row in rows]
+    if cancelled:
+        restore_stock(db, cancelled)
+        # Paid orders leave the sales rollup (orders cancelled while pending were never in it)
+        sales_rollup.remove_orders(db, [row.id for row in rows if row.payment_status in sales_rollup.PAID_STATUSES])
+        # Stock changed, so cached catalog reads must pick it up
+        catalog_cache.bump_stock_version(db)
+    return cancelled
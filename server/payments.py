@@ -0,0 +1,233 @@
+"""
+M-Pesa payment initiation as a background job.
+
+Checkout and payment retries only enqueue an ``stk_push`` job in the order
+transaction; the worker process performs the slow Daraja round trips.
+Callbacks are appended to an inbox table by the web handler and applied
+to orders in batches by the same worker.
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+from datetime import datetime
+from typing import Any, Dict, Iterable, NamedTuple, Optional
+
+from sqlalchemy import case, select, update
+from sqlalchemy.orm import Session
+
+import jobs
+import mpesa
+import sales_rollup
+from db import Job, MpesaCallback, Order, SessionLocal, StkRequest
+
+logger = logging.getLogger(__name__)
+
+STK_PUSH_JOB = "stk_push"
+# Worst case for one attempt: 15s token request plus 30s push request
+STK_PUSH_TIMEOUT_SECONDS = 50
+
+CALLBACK_POLL_SECONDS = 1.0
+CALLBACK_BATCH_SIZE = 500
+
+
+def normalize_phone(phone: str) -> str:
+    """Convert local formats (07..., 7...) to the 2547XXXXXXXX format Daraja expects"""
+    phone = phone.strip().replace(" ", "").lstrip("+")
+    if phone.startswith("0"):
+        return "254" + phone[1:]
+    if not phone.startswith("254"):
+        return "254" + phone
+    return phone
+
+
+def order_reference(order_id: int) -> str:
+    return f"order:{order_id}"
+
+
+def enqueue_stk_push(db: Session, order: Order) -> Job:
+    """Schedule an STK push for an order; call before committing the order"""
+    return jobs.enqueue(
+        db,
+        STK_PUSH_JOB,
+        {"order_id": order.id},
+        reference=order_reference(order.id),
+    )
+
+
+def stk_push_status(db: Session, order_id: int) -> Optional[str]:
+    """Status of the latest STK push job for an order (pending/running/done/failed)"""
+    job = jobs.latest_for(db, order_reference(order_id))
+    return job.status if job else None
+
+
+@jobs.register(STK_PUSH_JOB)
+def run_stk_push(payload: Dict[str, Any]) -> None:
+    order_id = int(payload["order_id"])
+    with SessionLocal() as db:
+        order = db.get(Order, order_id)
+        if order is None:
+            raise jobs.PermanentJobError(f"Order {order_id} no longer exists")
+        if order.payment_status != "pending":
+            logger.info(f"Skipping STK push for order {order_id}: payment is {order.payment_status}")
+            return
+        phone, amount = normalize_phone(order.customer_phone), float(order.total)
+
+    try:
+        result = mpesa.submit(mpesa.initiate_stk_push(str(order_id), phone, amount)).result(STK_PUSH_TIMEOUT_SECONDS)
+    except ValueError as e:
+        raise jobs.PermanentJobError(str(e)) from e
+
+    checkout_req_id = result.get("CheckoutRequestID") if isinstance(result, dict) else None
+    if not checkout_req_id:
+        raise RuntimeError(f"STK push response has no CheckoutRequestID: {result}")
+
+    with SessionLocal() as db:
+        # Kept even if the order moved on: the customer may still approve this prompt
+        db.add(StkRequest(checkout_request_id=checkout_req_id, order_id=order_id))
+        order = db.get(Order, order_id)
+        if order is not None and order.payment_status == "pending":
+            order.checkout_request_id = checkout_req_id
+        db.commit()
+    logger.info(f"STK push initiated for order {order_id}: {result}")
+
+
+class StkResult(NamedTuple):
+    checkout_request_id: str
+    result_code: Any
+    receipt: Optional[str] = None
+    description: Optional[str] = None
+
+
+def parse_stk_callback(body: Dict[str, Any]) -> StkResult:
+    """Raises KeyError/TypeError for bodies that are not STK callbacks"""
+    stk = body["Body"]["stkCallback"]
+    receipt = None
+    for item in (stk.get("CallbackMetadata") or {}).get("Item", []):
+        if item.get("Name") == "MpesaReceiptNumber":
+            receipt = item.get("Value")
+            break
+    return StkResult(stk["CheckoutRequestID"], stk.get("ResultCode"), receipt, stk.get("ResultDesc"))
+
+
+def apply_stk_results(db: Session, results: Iterable[StkResult]) -> int:
+    """
+    Apply STK push outcomes to their orders, found in one query through
+    stk_requests so results for earlier pushes of an order still count.
+    Safe to repeat: only pending orders are updated. The caller commits.
+    Returns the number of orders marked paid.
+    """
+    results = list(results)
+    if not results:
+        return 0
+    orders = {
+        row.checkout_request_id: row
+        for row in db.execute(
+            select(StkRequest.checkout_request_id, Order.id, Order.payment_status, Order.mpesa_receipt)
+            .join(Order, Order.id == StkRequest.order_id)
+            .where(StkRequest.checkout_request_id.in_({r.checkout_request_id for r in results}))
+        )
+    }
+
+    paid_ids = []
+    for result in results:
+        order = orders.get(result.checkout_request_id)
+        if order is None:
+            logger.warning(f"Order not found for M-Pesa callback. ReqID: {result.checkout_request_id}")
+            continue
+        succeeded = str(result.result_code) == "0"
+        db.execute(
+            update(StkRequest)
+            .where(StkRequest.checkout_request_id == result.checkout_request_id)
+            .values(status="succeeded" if succeeded else "failed")
+            .execution_options(synchronize_session=False)
+        )
+        if not succeeded:
+            # The order stays pending so the customer can retry the payment;
+            # the dead push is marked failed so reconciliation stops querying it
+            logger.warning(f"Payment failed for order {order.id}. Code: {result.result_code}, Desc: {result.description}")
+            db.execute(
+                update(Order)
+                .where(Order.id == order.id, Order.checkout_request_id == result.checkout_request_id,
+                       Order.payment_status == "pending")
+                .values(checkout_request_id=None)
+                .execution_options(synchronize_session=False)
+            )
+            continue
+
+        # STK query results confirm the payment but carry no receipt number.
+        # An order the admin cancelled meanwhile records the payment (for a
+        # refund) but stays cancelled, since its stock was already restored.
+        values = {
+            "payment_status": "completed",
+            "order_status": case((Order.order_status == "cancelled", "cancelled"), else_="paid"),
+        }
+        if result.receipt:
+            values.update(mpesa_receipt=result.receipt, mpesa_transaction_id=result.receipt)
+        paid = db.execute(
+            update(Order)
+            .where(Order.id == order.id, Order.payment_status == "pending")
+            .values(**values)
+            .returning(Order.order_status)
+            .execution_options(synchronize_session=False)
+        ).scalar()
+        if paid == "cancelled":
+            logger.warning(f"Payment {result.receipt} received for cancelled order {order.id}; refund required")
+        elif paid:
+            paid_ids.append(order.id)
+            logger.info(f"Payment confirmed for order {order.id}, Receipt: {result.receipt}")
+        elif order.payment_status == "completed" and (not result.receipt or order.mpesa_receipt == result.receipt):
+            logger.info(f"Duplicate M-Pesa result for order {order.id}, Receipt: {result.receipt}")
+        elif order.id in paid_ids:
+            logger.warning(f"M-Pesa payment {result.receipt} received for order {order.id} that another push just paid")
+        else:
+            logger.warning(f"M-Pesa payment {result.receipt} received for order {order.id} whose payment is {order.payment_status}")
+    sales_rollup.add_orders(db, paid_ids)
+    return len(paid_ids)
+
+
+def record_callback(db: Session, raw_body: str, checkout_request_id: str) -> None:
+    """Append a raw callback to the inbox; the worker applies it later"""
+    db.add(MpesaCallback(checkout_request_id=checkout_request_id, body=raw_body))
+
+
+@jobs.periodic(CALLBACK_POLL_SECONDS)
+def process_callback_inbox(batch_size: int = CALLBACK_BATCH_SIZE) -> int:
+    """Apply unprocessed callbacks in batches, one transaction per batch"""
+    total = 0
+    while True:
+        with SessionLocal() as db:
+            rows = db.scalars(
+                select(MpesaCallback)
+                .where(MpesaCallback.processed_at.is_(None))
+                .order_by(MpesaCallback.id)
+                .limit(batch_size)
+            ).all()
+            if not rows:
+                return total
+
+            # Safaricom redelivers callbacks; keep one per CheckoutRequestID,
+            # preferring a success over failures
+            latest: Dict[str, StkResult] = {}
+            for row in rows:
+                try:
+                    result = parse_stk_callback(json.loads(row.body))
+                except (KeyError, TypeError, ValueError):
+                    logger.error(f"Ignoring malformed M-Pesa callback {row.id}")
+                    continue
+                seen = latest.get(result.checkout_request_id)
+                if seen is None or str(seen.result_code) != "0":
+                    latest[result.checkout_request_id] = result
+
+            apply_stk_results(db, latest.values())
+            db.execute(
+                update(MpesaCallback)
+                .where(MpesaCallback.id.in_([row.id for row in rows]))
+                .values(processed_at=datetime.utcnow())
+                .execution_options(synchronize_session=False)
+            )
+            db.commit()
+            total += len(rows)
+            if len(rows) < batch_size:
+                return total
@@ -0,0 +1,117 @@
+from __future__ import annotations
+
+import logging
+import re
+from typing import Optional
+
+from sqlalchemy import Float, Integer, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import Subquery
+
+from db import Product
+
+logger = logging.getLogger(__name__)
+
+# BM25 column weights for (name, description, category): a hit in the name
+# matters far more than one buried in the description.
+BM25_WEIGHTS = (10.0, 2.0, 4.0)
+
+_fts_enabled = False
+
+
+def is_enabled() -> bool:
+    return _fts_enabled
+
+
+def ensure_index(engine: Engine) -> None:
+    """Create the FTS5 table if needed and rebuild it when it has drifted from products"""
+    global _fts_enabled
+    if engine.dialect.name != "sqlite":
+        logger.info("Full-text search disabled: FTS5 requires SQLite")
+        return
+    try:
+        with engine.begin() as conn:
+            conn.execute(text(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS products_fts "
+                "USING fts5(name, description, category, tokenize='unicode61 remove_diacritics 2')"
+            ))
+            indexed = conn.execute(text("SELECT count(*) FROM products_fts")).scalar_one()
+            total = conn.execute(text("SELECT count(*) FROM products")).scalar_one()
+            if indexed != total:
+                logger.info(f"Rebuilding product search index ({indexed} indexed, {total} products)")
+                _rebuild(conn)
+    except OperationalError as e:
+        logger.warning(f"Full-text search disabled: {e}")
+        return
+    _fts_enabled = True
+
+
+def rebuild_index(engine: Engine) -> None:
+    """Re-index every product, e.g. after bulk imports that bypass the admin API"""
+    if not _fts_enabled:
+        return
+    with engine.begin() as conn:
+        _rebuild(conn)
+
+
+def _rebuild(conn) -> None:
+    conn.execute(text("DELETE FROM products_fts"))
+    conn.execute(text(
+        "INSERT INTO products_fts (rowid, name, description, category) "
+        "SELECT id, name, coalesce(description, ''), category FROM products"
+    ))
+
+
+def index_product(db: Session, product: Product) -> None:
+    """Insert or refresh a product's search entry inside the caller's transaction"""
+    if not _fts_enabled:
+        return
+    db.execute(text("DELETE FROM products_fts WHERE rowid = :id"), {"id": product.id})
+    db.execute(
+        text("INSERT INTO products_fts (rowid, name, description, category) VALUES (:id, :name, :description, :category)"),
+        {
+            "id": product.id,
+            "name": product.name,
+            "description": product.description or "",
+            "category": product.category,
+        },
+    )
+
+
+def unindex_product(db: Session, product_id: int) -> None:
+    if not _fts_enabled:
+        return
+    db.execute(text("DELETE FROM products_fts WHERE rowid = :id"), {"id": product_id})
+
+
+def build_match_expression(search: str) -> Optional[str]:
+    """Turn free text into an FTS5 query where every word is a prefix term"""
+    tokens = re.findall(r"\w+", search.lower())
+    if not tokens:
+        return None
+    return " ".join(f'"{t}"*' for t in tokens)
+
+
+def match_subquery(search: str) -> Optional[Subquery]:
+    """
+    Subquery of (id, score) for products matching the search, or None when
+    full-text search is unavailable and the caller should fall back to LIKE.
+    Lower scores rank higher (BM25 as reported by SQLite is negative).
+    """
+    if not _fts_enabled:
+        return None
+    expr = build_match_expression(search)
+    if expr is None:
+        return None
+    weights = ", ".join(str(w) for w in BM25_WEIGHTS)
+    return (
+        text(
+            f"SELECT rowid AS id, bm25(products_fts, {weights}) AS score "
+            "FROM products_fts WHERE products_fts MATCH :match"
+        )
+        .bindparams(match=expr)
+        .columns(id=Integer, score=Float)
+        .subquery("fts_hits")
+    )
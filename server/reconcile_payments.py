@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""
+Reconcile M-Pesa orders whose callback never arrived.
+
+Unanswered STK pushes of stale pending orders (every push in
+stk_requests, not only an order's latest) are checked with the STK Push
+Query API, concurrently (MPESA_QUERY_CONCURRENCY) and under a request
+rate cap (MPESA_QUERY_RATE per second). Results are
+applied in one transaction per chunk. The job worker runs this every few
+minutes; to run it once by hand:
+
+    cd server && python reconcile_payments.py
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import List, Optional, Sequence, Tuple
+
+from sqlalchemy import select
+
+import jobs
+import mpesa
+from config import config
+from db import Order, SessionLocal, StkRequest
+from payments import StkResult, apply_stk_results
+
+logger = logging.getLogger(__name__)
+
+RECONCILE_INTERVAL_SECONDS = 300  # between the starts of two passes
+TICK_SECONDS = 5
+# Leave time for the callback before asking; Daraja only keeps recent pushes
+STALE_AFTER = timedelta(minutes=3)
+MAX_AGE = timedelta(days=2)
+# A chunk is sized to take about CHUNK_SECONDS at MPESA_QUERY_RATE, so a
+# worker tick is never held up for long
+CHUNK_SECONDS = 2
+MAX_CHUNK_SIZE = 1000
+QUERY_TIMEOUT_SECONDS = 60
+
+
+def _chunk_size() -> int:
+    if config.mpesa_query_rate <= 0:
+        return MAX_CHUNK_SIZE
+    return max(1, min(MAX_CHUNK_SIZE, int(config.mpesa_query_rate * CHUNK_SECONDS)))
+
+
+class _RateLimiter:
+    """Spaces request starts at least 1/rate seconds apart"""
+
+    def __init__(self, rate: float) -> None:
+        self._interval = 1.0 / rate if rate > 0 else 0.0
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self) -> None:
+        loop = asyncio.get_running_loop()
+        async with self._lock:
+            delay = self._next - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._next = max(loop.time(), self._next) + self._interval
+
+
+async def _query_all(checkout_ids: Sequence[str]) -> List[Optional[StkResult]]:
+    semaphore = asyncio.Semaphore(max(1, config.mpesa_query_concurrency))
+    limiter = _RateLimiter(config.mpesa_query_rate)
+
+    async def query(checkout_id: str) -> Optional[StkResult]:
+        async with semaphore:
+            await limiter.wait()
+            try:
+                body = await mpesa.query_stk_status(checkout_id)
+            except Exception as e:
+                logger.warning(f"STK query failed for {checkout_id}: {type(e).__name__} - {str(e)}")
+                return None
+        if "ResultCode" not in body:
+            # Still waiting for the customer, or a transient Daraja error
+            return None
+        return StkResult(checkout_id, body["ResultCode"], None, body.get("ResultDesc"))
+
+    return await asyncio.gather(*(query(checkout_id) for checkout_id in checkout_ids))
+
+
+def _stale_pushes(after: str, now: datetime) -> List[str]:
+    """Unanswered pushes of pending orders, every push not only the latest, by checkout id after `after`"""
+    with SessionLocal() as db:
+        return list(db.scalars(
+            select(StkRequest.checkout_request_id)
+            .join(Order, Order.id == StkRequest.order_id)
+            .where(
+                StkRequest.status == "pending",
+                StkRequest.created_at.between(now - MAX_AGE, now - STALE_AFTER),
+                StkRequest.checkout_request_id > after,
+                Order.payment_status == "pending",
+                Order.payment_method == "mpesa",
+            )
+            .order_by(StkRequest.checkout_request_id)
+            .limit(_chunk_size())
+        ))
+
+
+def _reconcile_chunk(after: str, now: datetime) -> Tuple[Optional[str], int, int]:
+    """Query and apply one chunk. Returns (cursor for the next chunk or None when done, pushes checked, orders paid)"""
+    stale = _stale_pushes(after, now)
+    if not stale:
+        return None, 0, 0
+    results = mpesa.submit(_query_all(stale)).result(QUERY_TIMEOUT_SECONDS)
+    with SessionLocal() as db:
+        paid = apply_stk_results(db, [r for r in results if r is not None])
+        db.commit()
+    return (stale[-1] if len(stale) == _chunk_size() else None), len(stale), paid
+
+
+def reconcile_pending_payments() -> Tuple[int, int]:
+    """Run a full pass. Returns (pushes checked, orders marked paid)"""
+    now = datetime.utcnow()
+    checked = paid = 0
+    after: Optional[str] = ""
+    while after is not None:
+        after, chunk_checked, chunk_paid = _reconcile_chunk(after, now)
+        checked += chunk_checked
+        paid += chunk_paid
+    return checked, paid
+
+
+# The pass in progress in the worker: cursor (None between passes) and its start time
+_pass_after: Optional[str] = None
+_pass_now: Optional[datetime] = None
+_pass_totals = [0, 0]
+_next_pass = 0.0
+
+
+@jobs.periodic(TICK_SECONDS)
+def reconcile_step() -> None:
+    """
+    One bounded chunk per worker tick. A pass over thousands of pending
+    pushes is spread over many ticks, so STK push jobs and the callback
+    inbox keep running in between.
+    """
+    global _pass_after, _pass_now, _next_pass
+    if _pass_after is None:
+        if time.monotonic() < _next_pass:
+            return
+        _pass_after, _pass_now = "", datetime.utcnow()
+        _pass_totals[:] = [0, 0]
+        _next_pass = time.monotonic() + RECONCILE_INTERVAL_SECONDS
+
+    try:
+        _pass_after, checked, paid = _reconcile_chunk(_pass_after, _pass_now)
+    except Exception:
+        # Next pass starts over; pushes are only marked once a result is applied
+        _pass_after = None
+        raise
+    _pass_totals[0] += checked
+    _pass_totals[1] += paid
+    if _pass_after is None and _pass_totals[0]:
+        logger.info(f"Reconciled {_pass_totals[0]} pending M-Pesa pushes, {_pass_totals[1]} orders marked paid")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    checked, paid = reconcile_pending_payments()
+    print(f"✓ Checked {checked} pending M-Pesa pushes, {paid} orders marked paid")
@@ -5,8 +5,12 @@ from typing import Optional
 
 from flask import Blueprint, jsonify, request, session
 
-from db import Product, SessionLocal, User, Order
-import json
+import catalog_cache
+import product_search
+import sales_rollup
+from db import Product, SessionLocal, User, Order, begin_write
+from low_stock import DEFAULT_REORDER_THRESHOLD
+from order_items import cancel_orders, items_for_orders
 
 bp_admin = Blueprint("admin", __name__, url_prefix="/api/admin")
 
@@ -68,8 +72,12 @@ def admin_add_product():
             in_stock=bool(data.get("inStock", True)) and int(data.get("stockQuantity", 0)) > 0,
             delivery_price=float(data["deliveryPrice"]) if data.get("deliveryPrice") else None,
             discount=float(data["discount"]) if data.get("discount") else None,
+            reorder_threshold=int(data.get("reorderThreshold", DEFAULT_REORDER_THRESHOLD)),
         )
         db.add(p)
+        db.flush()
+        product_search.index_product(db, p)
+        catalog_cache.bump_version(db)
         db.commit()
         db.refresh(p)
         return jsonify({
@@ -84,6 +92,7 @@ def admin_add_product():
             "inStock": bool(p.in_stock) and p.stock_quantity > 0,
             "deliveryPrice": p.delivery_price,
             "discount": p.discount,
+            "reorderThreshold": p.reorder_threshold,
             "createdAt": p.created_at.isoformat(),
         })
 
@@ -119,7 +128,12 @@ def admin_update_product(product_id: int):
             product.delivery_price = float(data["deliveryPrice"]) if data["deliveryPrice"] else None
         if "discount" in data:
             product.discount = float(data["discount"]) if data["discount"] else None
+        if "reorderThreshold" in data:
+            product.reorder_threshold = int(data["reorderThreshold"])
         
+        if any(k in data for k in ("name", "description", "category")):
+            product_search.index_product(db, product)
+        catalog_cache.bump_version(db)
         db.commit()
         db.refresh(product)
         
@@ -135,6 +149,7 @@ def admin_update_product(product_id: int):
             "inStock": bool(product.in_stock) and product.stock_quantity > 0,
             "deliveryPrice": product.delivery_price,
             "discount": product.discount,
+            "reorderThreshold": product.reorder_threshold,
             "createdAt": product.created_at.isoformat(),
         })
 
@@ -151,6 +166,8 @@ def admin_delete_product(product_id: int):
             return jsonify({"message": "Product not found"}), 404
         
         db.delete(product)
+        product_search.unindex_product(db, product_id)
+        catalog_cache.bump_version(db)
         db.commit()
         
         return jsonify({"message": "Product deleted"})
@@ -175,6 +192,7 @@ def admin_restock_product(product_id: int):
         
         product.stock_quantity += quantity
         product.in_stock = True
+        catalog_cache.bump_stock_version(db)
         db.commit()
         db.refresh(product)
         
@@ -234,17 +252,16 @@ def admin_list_orders():
     
     with SessionLocal() as db:
         orders = db.query(Order).order_by(Order.created_at.desc()).all()
+        items_by_order = items_for_orders(db, orders)
+        user_ids = {o.user_id for o in orders if o.user_id}
+        users = {u.id: u for u in db.query(User).filter(User.id.in_(user_ids))} if user_ids else {}
         orders_data = []
         for o in orders:
-            items = []
-            try:
-                items = json.loads(o.items) if isinstance(o.items, str) else o.items
-            except:
-                pass
+            items = items_by_order[o.id]
             
             user_info = None
             if o.user_id:
-                u = db.query(User).get(o.user_id)
+                u = users.get(o.user_id)
                 if u:
                     user_info = {
                         "id": u.id,
@@ -287,11 +304,7 @@ def admin_get_order(order_id: int):
         if not order:
             return jsonify({"message": "Order not found"}), 404
         
-        items = []
-        try:
-            items = json.loads(order.items) if isinstance(order.items, str) else order.items
-        except:
-            pass
+        items = items_for_orders(db, [order])[order.id]
         
         user_info = None
         if order.user_id:
@@ -359,13 +372,10 @@ def admin_get_user_orders(user_id: int):
             return jsonify({"message": "User not found"}), 404
         
         orders = db.query(Order).filter(Order.user_id == user_id).all()
+        items_by_order = items_for_orders(db, orders)
         orders_data = []
         for o in orders:
-            items = []
-            try:
-                items = json.loads(o.items) if isinstance(o.items, str) else o.items
-            except:
-                pass
+            items = items_by_order[o.id]
             
             orders_data.append({
                 "id": o.id,
@@ -424,15 +434,33 @@ def admin_update_order(order_id: int):
     
     data = request.get_json(force=True) or {}
     with SessionLocal() as db:
-        order = db.query(Order).get(order_id)
+        begin_write(db)
+        order = db.get(Order, order_id)
         if not order:
             return jsonify({"message": "Order not found"}), 404
         
-        if "orderStatus" in data:
+        if order.order_status == "cancelled" and data.get("orderStatus", "cancelled") != "cancelled":
+            # Its stock is already back on the shelf; reopening would sell it twice
+            return jsonify({"message": "Cannot reopen a cancelled order"}), 400
+
+        counted = sales_rollup.is_counted(order)
+        if data.get("orderStatus") == "cancelled":
+            # Guarded so a repeated cancel doesn't put the stock back twice;
+            # it also takes a paid order out of the sales rollup
+            cancel_orders(db, [Order.id == order_id])
+            db.refresh(order)
+            counted = sales_rollup.is_counted(order)
+        elif "orderStatus" in data:
             order.order_status = data["orderStatus"]
         if "paymentStatus" in data:
             order.payment_status = data["paymentStatus"]
-        
+
+        db.flush()
+        if sales_rollup.is_counted(order) != counted:
+            if counted:
+                sales_rollup.remove_orders(db, [order.id])
+            else:
+                sales_rollup.add_orders(db, [order.id])
         db.commit()
         db.refresh(order)
         
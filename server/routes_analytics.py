@@ -1,53 +1,64 @@
 from __future__ import annotations
 
-import json
-from datetime import datetime, timedelta
-from flask import Blueprint, jsonify
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+from flask import Blueprint, jsonify, request
+from sqlalchemy import func, select
 from sqlalchemy.orm import Session
 
-from db import Order, SessionLocal
+from db import DailySales, Order, Product, ProductDailySales, SessionLocal
+from sales_rollup import distinct_customers
 
 
 bp_analytics = Blueprint("analytics", __name__, url_prefix="/api")
 
+DEFAULT_PRODUCT_RANGE_DAYS = 30
+DEFAULT_PRODUCT_LIMIT = 10
+MAX_PRODUCT_LIMIT = 100
+
+
+def _top_products(session: Session, limit: int, start: Optional[str] = None, end: Optional[str] = None) -> List[Dict[str, Any]]:
+    """Best sellers by revenue from the product_daily_sales rollup, optionally between two YYYY-MM-DD days"""
+    units = func.sum(ProductDailySales.units)
+    revenue = func.sum(ProductDailySales.revenue)
+    stmt = (
+        select(ProductDailySales.product_id, Product.name, Product.image, units, revenue)
+        .outerjoin(Product, Product.id == ProductDailySales.product_id)
+        .group_by(ProductDailySales.product_id, Product.name, Product.image)
+        .having(units > 0)
+        .order_by(revenue.desc())
+        .limit(limit)
+    )
+    if start:
+        stmt = stmt.where(ProductDailySales.date >= start)
+    if end:
+        stmt = stmt.where(ProductDailySales.date <= end)
+    return [
+        {
+            "id": str(pid),
+            "name": name or f"Product #{pid}",  # deleted since it was sold
+            "image": image,
+            "sales": int(count or 0),
+            "revenue": float(total or 0),
+        }
+        for pid, name, image, count, total in session.execute(stmt)
+    ]
+
 
 @bp_analytics.get("/analytics")
 def analytics():
     with SessionLocal() as session:  # type: Session
-        orders = session.query(Order).all()
-        # Include 'completed' and 'paid' statuses
-        completed = [o for o in orders if o.payment_status in ["completed", "paid", "success"]]
-        total_revenue = sum(float(o.total) for o in completed)
-        total_orders = len(orders)
+        total_orders, active_customers = session.execute(
+            select(func.count(Order.id), func.count(func.distinct(Order.customer_phone)))
+        ).one()
+        # Same rule as weeklySales: paid orders that weren't cancelled, from the rollup
+        total_revenue = float(session.scalar(select(func.coalesce(func.sum(DailySales.revenue), 0))))
         avg_order_value = (total_revenue / total_orders) if total_orders else 0.0
-        active_customers = len({o.customer_phone for o in orders})
-
-        product_sales = {}
-        for o in completed:
-            try:
-                items = json.loads(o.items) if isinstance(o.items, str) else o.items
-            except Exception:
-                items = []
-            for it in items:
-                pid = str(it.get("id"))
-                entry = product_sales.setdefault(pid, {"count": 0, "revenue": 0.0, "product": it})
-                entry["count"] += int(it.get("quantity", 0))
-                entry["revenue"] += float(it.get("quantity", 0)) * float(it.get("price", 0))
-
-        top_products = [
-            {
-                "id": pid,
-                "name": data["product"].get("name"),
-                "image": data["product"].get("image"),
-                "sales": data["count"],
-                "revenue": data["revenue"],
-            }
-            for pid, data in product_sales.items()
-        ]
-        top_products.sort(key=lambda x: x["revenue"], reverse=True)
-        top_products = top_products[:5]
 
-        orders.sort(key=lambda o: o.created_at, reverse=True)
+        top_products = _top_products(session, limit=5)
+
+        recent_orders = session.scalars(select(Order).order_by(Order.created_at.desc()).limit(10))
         recent = [
             {
                 "id": o.id,
@@ -56,32 +67,29 @@ def analytics():
                 "paymentStatus": o.payment_status,
                 "createdAt": o.created_at.isoformat(),
             }
-            for o in orders[:10]
+            for o in recent_orders
         ]
-        
+
         # Calculate Weekly Sales
         today = datetime.utcnow().date()
+        first_day = (today - timedelta(days=6)).isoformat()
+        daily_revenue = dict(session.execute(
+            select(DailySales.date, DailySales.revenue).where(DailySales.date >= first_day)
+        ).all())
         weekly_sales = []
         for i in range(6, -1, -1):
-            date_val = today - timedelta(days=i)
-            # Filter orders for this day (and completed)
-            day_orders = [o for o in completed if o.created_at.date() == date_val]
-            day_revenue = sum(float(o.total) for o in day_orders)
+            date_str = (today - timedelta(days=i)).strftime("%Y-%m-%d")
             weekly_sales.append({
-                "date": date_val.strftime("%Y-%m-%d"),
-                "sales": day_revenue
+                "date": date_str,
+                "sales": float(daily_revenue.get(date_str) or 0),
             })
 
-
-
         return jsonify({
             "totalRevenue": total_revenue,
             "totalOrders": total_orders,
             "avgOrderValue": avg_order_value,
             "activeCustomers": active_customers,
             "topProducts": top_products,
-            "activeCustomers": active_customers,
-            "topProducts": top_products,
             "recentOrders": recent,
             "weeklySales": weekly_sales,
         })
@@ -90,39 +98,55 @@ def analytics():
 @bp_analytics.get("/analytics/history")
 def analytics_history():
     with SessionLocal() as session:
-        # Get orders from last 90 days
+        # Last 90 days from the daily_sales rollup
         end_date = datetime.utcnow()
         start_date = end_date - timedelta(days=90)
-        
-        orders = session.query(Order).filter(
-            Order.created_at >= start_date,
-            Order.payment_status.in_(["completed", "paid", "success"])
-        ).all()
-        
-        daily_data = {}
-        for o in orders:
-            d_str = o.created_at.strftime("%Y-%m-%d")
-            if d_str not in daily_data:
-                daily_data[d_str] = {"sales": 0.0, "orders": 0}
-            daily_data[d_str]["sales"] += float(o.total)
-            daily_data[d_str]["orders"] += 1
-            
+        daily_data = {
+            row.date: row
+            for row in session.scalars(select(DailySales).where(DailySales.date >= start_date.strftime("%Y-%m-%d")))
+        }
+
         result = []
         current = start_date
         while current <= end_date:
             d_str = current.strftime("%Y-%m-%d")
-            val = daily_data.get(d_str, {"sales": 0.0, "orders": 0})
+            val = daily_data.get(d_str)
             
             # Format date for frontend (e.g. "Oct 1")
             formatted_date = current.strftime("%b %d").replace(" 0", " ")
             
             result.append({
                 "date": formatted_date,
-                "value": val["sales"],
-                "orderCount": val["orders"],
+                "value": val.revenue if val else 0.0,
+                "orderCount": val.orders if val else 0,
+                "itemCount": val.items if val else 0,
+                "customerCount": distinct_customers([val.distinct_customers_sketch]) if val else 0,
                 "type": "actual"
             })
             current += timedelta(days=1)
             
         return jsonify(result)
 
+
+@bp_analytics.get("/analytics/products")
+def analytics_products():
+    """Top products by revenue between from and to (inclusive YYYY-MM-DD, default the last 30 days)"""
+    try:
+        end = date.fromisoformat(request.args["to"]) if request.args.get("to") else datetime.utcnow().date()
+        start = (
+            date.fromisoformat(request.args["from"]) if request.args.get("from")
+            else end - timedelta(days=DEFAULT_PRODUCT_RANGE_DAYS - 1)
+        )
+        limit = int(request.args.get("limit", DEFAULT_PRODUCT_LIMIT))
+    except ValueError:
+        return jsonify({"message": "Invalid date range or limit"}), 400
+    if start > end:
+        return jsonify({"message": "Invalid date range or limit"}), 400
+    limit = max(1, min(limit, MAX_PRODUCT_LIMIT))
+
+    days = (end - start).days + 1
+    with SessionLocal() as session:
+        products = _top_products(session, limit, start.isoformat(), end.isoformat())
+    for p in products:
+        p["unitsPerDay"] = round(p["sales"] / days, 2)
+    return jsonify({"from": start.isoformat(), "to": end.isoformat(), "products": products})
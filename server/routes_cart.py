@@ -1,77 +1,163 @@
 from __future__ import annotations
 
 import json
-from typing import Any, Dict, List
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Tuple
 
 from flask import Blueprint, jsonify, request, session
+from sqlalchemy import and_, case, delete, insert, or_, select
 from sqlalchemy.orm import Session
 
-from db import Cart, Product, SessionLocal
+from db import Cart, CartItem, Product, SessionLocal, dialect_insert
 
 bp_cart = Blueprint("cart", __name__, url_prefix="/api/cart")
 
+CART_OPERATIONS = ("set", "inc", "remove")
 
-def _get_user_cart(db: Session, user_id: int) -> Cart:
-    cart = db.query(Cart).filter(Cart.user_id == user_id).first()
-    if not cart:
-        cart = Cart(user_id=user_id, items="[]")
-        db.add(cart)
-        db.commit()
-        db.refresh(cart)
+
+def _load_products(db: Session, product_ids: Iterable[Any]) -> Dict[int, Product]:
+    """Fetch every referenced product with a single IN query, keyed by id"""
+    ids = set()
+    for pid in product_ids:
+        try:
+            ids.add(int(pid))
+        except (TypeError, ValueError):
+            continue
+    if not ids:
+        return {}
+    return {p.id: p for p in db.scalars(select(Product).where(Product.id.in_(ids)))}
+
+
+def _lookup(products: Dict[int, Product], product_id: Any) -> Optional[Product]:
+    try:
+        return products.get(int(product_id))
+    except (TypeError, ValueError):
+        return None
+
+
+def _cart_line(product: Product, quantity: int) -> Dict[str, Any]:
+    return {
+        "id": product.id,
+        "name": product.name,
+        "price": float(product.price) if product.price is not None else 0,
+        "image": product.image,
+        "quantity": quantity,
+        "availableStock": product.stock_quantity,
+        "inStock": product.in_stock,
+        "deliveryPrice": float(product.delivery_price) if product.delivery_price is not None else 0,
+        "discount": float(product.discount) if product.discount is not None else 0,
+    }
+
+
+def migrate_legacy_items(db: Session, cart: Cart) -> None:
+    """Move lines still stored in the old JSON column into cart_items, in the caller's transaction"""
+    try:
+        legacy = json.loads(cart.items) if cart.items else []
+    except ValueError:
+        legacy = []
+    quantities: Dict[int, int] = {}
+    for item in legacy:
+        try:
+            pid = int(item.get("id"))
+            quantities[pid] = quantities.get(pid, 0) + int(item.get("quantity", 1))
+        except (TypeError, ValueError, AttributeError):
+            continue
+    if quantities:
+        db.execute(delete(CartItem).where(CartItem.cart_id == cart.id, CartItem.product_id.in_(quantities)))
+        db.execute(insert(CartItem), [
+            {"cart_id": cart.id, "product_id": pid, "quantity": qty}
+            for pid, qty in quantities.items() if qty > 0
+        ])
+    cart.items = "[]"
+    # Part of the caller's transaction; it commits along with its own changes
+    db.flush()
+
+
+def _find_cart(db: Session, user_id: int) -> Optional[Cart]:
+    """The user's cart, or None; reads never create one"""
+    cart = db.scalar(select(Cart).where(Cart.user_id == user_id))
+    if cart is not None and cart.items and cart.items != "[]":
+        migrate_legacy_items(db, cart)
     return cart
 
 
+def _ensure_cart_id(db: Session, user_id: int) -> int:
+    """
+    Create the cart on the first mutation, inside the caller's transaction.
+    The unique user_id turns concurrent first writes into a no-op conflict.
+    """
+    cart = _find_cart(db, user_id)
+    if cart is not None:
+        return cart.id
+    now = datetime.utcnow()
+    db.execute(
+        dialect_insert(db)(Cart)
+        .values(user_id=user_id, items="[]", created_at=now, updated_at=now)
+        .on_conflict_do_nothing(index_elements=["user_id"])
+    )
+    return db.scalar(select(Cart.id).where(Cart.user_id == user_id))
+
+
+def _read_lines(db: Session, cart_id: int) -> Tuple[List[Dict[str, Any]], List[int]]:
+    """
+    Current cart lines joined with live product data in one query. Returns the
+    valid lines (quantities clamped to stock) and the product ids that are gone
+    or out of stock.
+    """
+    rows = db.execute(
+        select(CartItem, Product)
+        .join(Product, Product.id == CartItem.product_id, isouter=True)
+        .where(CartItem.cart_id == cart_id)
+        .order_by(CartItem.id)
+    ).all()
+    valid_items = []
+    stale_ids = []
+    for line, product in rows:
+        if product and product.stock_quantity > 0 and product.in_stock:
+            # Limit quantity to available stock
+            quantity = min(line.quantity, product.stock_quantity)
+            if quantity > 0:
+                valid_items.append(_cart_line(product, quantity))
+                continue
+        stale_ids.append(line.product_id)
+    return valid_items, stale_ids
+
+
+def _totals(items: List[Dict[str, Any]]) -> Dict[str, Any]:
+    item_count = sum(item.get("quantity", 0) for item in items)
+    subtotal = sum(item.get("price", 0) * item.get("quantity", 0) for item in items)
+    delivery_fee = 50.0 if subtotal > 0 else 0.0
+    # Per-product discount calculation
+    discount = sum(item.get("discount", 0) * item.get("quantity", 0) for item in items)
+    return {
+        "itemCount": item_count,
+        "subtotal": subtotal,
+        "deliveryFee": delivery_fee,
+        "discount": discount,
+        "total": subtotal + delivery_fee - discount,
+    }
+
+
 @bp_cart.get("")
 def get_cart():
     user_id = session.get("user_id")
     if not user_id:
         return jsonify({"items": [], "itemCount": 0, "subtotal": 0, "deliveryFee": 0, "discount": 0, "total": 0}), 200
-    
+
     with SessionLocal() as db:
-        cart = _get_user_cart(db, user_id)
-        items = json.loads(cart.items) if cart.items else []
-        
-        # Validate items against current product stock and sync with latest product data
-        valid_items = []
-        for item in items:
-            product = db.query(Product).get(item.get("id"))
-            if product and product.stock_quantity > 0 and product.in_stock:
-                # Limit quantity to available stock
-                quantity = min(item.get("quantity", 1), product.stock_quantity)
-                if quantity > 0:
-                    valid_items.append({
-                        "id": product.id,
-                        "name": product.name,
-                        "price": float(product.price) if product.price is not None else 0,
-                        "image": product.image,
-                        "quantity": quantity,
-                        "availableStock": product.stock_quantity,
-                        "inStock": product.in_stock,
-                        "deliveryPrice": float(product.delivery_price) if product.delivery_price is not None else 0,
-                        "discount": float(product.discount) if product.discount is not None else 0,
-                    })
-        
-        # Update cart if items were modified
-        if len(valid_items) != len(items):
-            cart.items = json.dumps(valid_items)
-            db.commit()
-        
-        # Calculate totals
-        item_count = sum(item.get("quantity", 0) for item in valid_items)
-        subtotal = sum(item.get("price", 0) * item.get("quantity", 0) for item in valid_items)
-        delivery_fee = 50.0 if subtotal > 0 else 0.0
-        # Per-product discount calculation
-        discount = sum(item.get("discount", 0) * item.get("quantity", 0) for item in valid_items)
-        total = subtotal + delivery_fee - discount
-        
-        return jsonify({
-            "items": valid_items,
-            "itemCount": item_count,
-            "subtotal": subtotal,
-            "deliveryFee": delivery_fee,
-            "discount": discount,
-            "total": total,
-        })
+        cart = _find_cart(db, user_id)
+        if cart is None:
+            # Virtual empty cart until the first real mutation
+            return jsonify({"items": [], **_totals([])})
+        valid_items, stale_ids = _read_lines(db, cart.id)
+
+        # Drop lines whose product disappeared or sold out
+        if stale_ids:
+            db.execute(delete(CartItem).where(CartItem.cart_id == cart.id, CartItem.product_id.in_(stale_ids)))
+        # Also keeps a legacy-items migration done by _find_cart
+        db.commit()
+
+        return jsonify({"items": valid_items, **_totals(valid_items)})
 
 
 @bp_cart.post("")
@@ -79,52 +165,40 @@ def add_to_cart():
     user_id = session.get("user_id")
     if not user_id:
         return jsonify({"message": "Unauthorized"}), 401
-    
+
     data = request.get_json(force=True) or {}
     product_id = data.get("productId") or data.get("id")
     quantity = int(data.get("quantity", 1))
-    
+
     if not product_id:
         return jsonify({"message": "Product ID required"}), 400
-    
+
     with SessionLocal() as db:
-        product = db.query(Product).get(product_id)
+        product = db.get(Product, product_id)
         if not product:
             return jsonify({"message": "Product not found"}), 404
-        
+
         if not product.in_stock or product.stock_quantity <= 0:
             return jsonify({"message": "Product is out of stock"}), 400
-        
+
         if quantity > product.stock_quantity:
             return jsonify({"message": f"Only {product.stock_quantity} items available"}), 400
-        
-        cart = _get_user_cart(db, user_id)
-        items = json.loads(cart.items) if cart.items else []
-        
-        # Find existing item
-        existing_idx = next((i for i, item in enumerate(items) if item.get("id") == product_id), None)
-        
-        if existing_idx is not None:
-            new_quantity = items[existing_idx].get("quantity", 0) + quantity
-            if new_quantity > product.stock_quantity:
-                return jsonify({"message": f"Only {product.stock_quantity} items available"}), 400
-            items[existing_idx]["quantity"] = new_quantity
-        else:
-            items.append({
-                "id": product.id,
-                "name": product.name,
-                "price": float(product.price) if product.price is not None else 0,
-                "image": product.image,
-                "quantity": quantity,
-                "availableStock": product.stock_quantity,
-                "inStock": product.in_stock,
-                "deliveryPrice": float(product.delivery_price) if product.delivery_price is not None else 0,
-                "discount": float(product.discount) if product.discount is not None else 0,
-            })
-        
-        cart.items = json.dumps(items)
+
+        cart_id = _ensure_cart_id(db, user_id)
+
+        # Single-row upsert; an existing line only grows while it stays within stock
+        stmt = dialect_insert(db)(CartItem).values(cart_id=cart_id, product_id=product.id, quantity=quantity)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["cart_id", "product_id"],
+            set_={"quantity": CartItem.quantity + stmt.excluded.quantity, "updated_at": datetime.utcnow()},
+            where=(CartItem.quantity + stmt.excluded.quantity) <= product.stock_quantity,
+        )
+        if db.execute(stmt).rowcount == 0:
+            db.rollback()
+            return jsonify({"message": f"Only {product.stock_quantity} items available"}), 400
         db.commit()
-        
+
+        items, _ = _read_lines(db, cart_id)
         return jsonify({"message": "Item added to cart", "items": items})
 
 
@@ -133,58 +207,137 @@ def update_cart():
     user_id = session.get("user_id")
     if not user_id:
         return jsonify({"message": "Unauthorized"}), 401
-    
+
     data = request.get_json(force=True) or {}
     items = data.get("items", [])
-    
+
     with SessionLocal() as db:
-        cart = _get_user_cart(db, user_id)
-        
+        cart_id = _ensure_cart_id(db, user_id)
+
         # Validate all items against stock
-        valid_items = []
+        products = _load_products(db, (item.get("id") for item in items))
+        quantities: Dict[int, int] = {}
         for item in items:
-            product_id = item.get("id")
             quantity = int(item.get("quantity", 0))
-            
+
             if quantity <= 0:
                 continue
-            
-            product = db.query(Product).get(product_id)
+
+            product = _lookup(products, item.get("id"))
             if not product or not product.in_stock or product.stock_quantity <= 0:
                 continue
-            
-            quantity = min(quantity, product.stock_quantity)
-            valid_items.append({
-                "id": product.id,
-                "name": product.name,
-                "price": float(product.price) if product.price is not None else 0,
-                "image": product.image,
-                "quantity": quantity,
-                "availableStock": product.stock_quantity,
-                "inStock": product.in_stock,
-                "deliveryPrice": float(product.delivery_price) if product.delivery_price is not None else 0,
-                "discount": float(product.discount) if product.discount is not None else 0,
-            })
-        
-        cart.items = json.dumps(valid_items)
+
+            quantities[product.id] = min(quantity, product.stock_quantity)
+
+        # Serialize before commit expires the loaded products
+        valid_items = [_cart_line(products[pid], qty) for pid, qty in quantities.items()]
+
+        # The request carries the whole cart, so replace every line
+        db.execute(delete(CartItem).where(CartItem.cart_id == cart_id))
+        if quantities:
+            db.execute(insert(CartItem), [
+                {"cart_id": cart_id, "product_id": pid, "quantity": qty}
+                for pid, qty in quantities.items()
+            ])
         db.commit()
-        
+
         return jsonify({"message": "Cart updated", "items": valid_items})
 
 
+@bp_cart.patch("")
+def patch_cart():
+    """
+    Apply a list of line operations without resending the cart:
+    {"operations": [{"op": "set" | "inc" | "remove", "productId": 1, "quantity": 2}]}
+    Only the named products are read and written. Responds with the affected
+    lines, the ids that left the cart and the new totals.
+    """
+    user_id = session.get("user_id")
+    if not user_id:
+        return jsonify({"message": "Unauthorized"}), 401
+
+    data = request.get_json(force=True) or {}
+    operations = data.get("operations")
+    if not isinstance(operations, list) or not operations:
+        return jsonify({"message": "operations must be a non-empty list"}), 400
+
+    # Fold the operations into one change per product: (True, n) sets the line
+    # to n, (False, n) adjusts whatever quantity is stored when we write
+    changes: Dict[int, Tuple[bool, int]] = {}
+    for op in operations:
+        kind = op.get("op") if isinstance(op, dict) else None
+        if kind not in CART_OPERATIONS:
+            return jsonify({"message": f"Unsupported cart operation: {kind}"}), 400
+        try:
+            product_id = int(op.get("productId") or op.get("id"))
+            quantity = int(op.get("quantity", 1))
+        except (TypeError, ValueError):
+            return jsonify({"message": "Each operation needs a productId and an integer quantity"}), 400
+
+        absolute, value = changes.get(product_id, (False, 0))
+        if kind == "set":
+            changes[product_id] = (True, max(quantity, 0))
+        elif kind == "remove":
+            changes[product_id] = (True, 0)
+        elif absolute:
+            changes[product_id] = (True, max(value + quantity, 0))
+        else:
+            changes[product_id] = (False, value + quantity)
+
+    with SessionLocal() as db:
+        cart_id = _ensure_cart_id(db, user_id)
+        products = _load_products(db, changes)
+        upsert = dialect_insert(db)
+
+        dropped = []
+        for product_id, (absolute, value) in changes.items():
+            product = products.get(product_id)
+            if not product or not product.in_stock or product.stock_quantity <= 0 or (absolute and value == 0):
+                dropped.append(product_id)
+                continue
+            stock = product.stock_quantity
+            stmt = upsert(CartItem).values(cart_id=cart_id, product_id=product_id, quantity=max(min(value, stock), 0))
+            if absolute:
+                new_quantity = stmt.excluded.quantity
+            else:
+                # Relative changes are applied in SQL so concurrent clicks don't overwrite each other
+                new_quantity = case((CartItem.quantity + value > stock, stock), else_=CartItem.quantity + value)
+            db.execute(stmt.on_conflict_do_update(
+                index_elements=["cart_id", "product_id"],
+                set_={"quantity": new_quantity, "updated_at": datetime.utcnow()},
+            ))
+
+        db.execute(delete(CartItem).where(
+            CartItem.cart_id == cart_id,
+            or_(CartItem.product_id.in_(dropped), and_(CartItem.product_id.in_(changes), CartItem.quantity <= 0)),
+        ))
+        db.commit()
+
+        valid_items, _ = _read_lines(db, cart_id)
+        affected = [item for item in valid_items if item["id"] in changes]
+        remaining = {item["id"] for item in affected}
+        return jsonify({
+            "message": "Cart updated",
+            "items": affected,
+            "removed": sorted(pid for pid in changes if pid not in remaining),
+            **_totals(valid_items),
+        })
+
+
 @bp_cart.delete("/<int:product_id>")
 def remove_from_cart(product_id: int):
     user_id = session.get("user_id")
     if not user_id:
         return jsonify({"message": "Unauthorized"}), 401
-    
+
     with SessionLocal() as db:
-        cart = _get_user_cart(db, user_id)
-        items = json.loads(cart.items) if cart.items else []
-        items = [item for item in items if item.get("id") != product_id]
-        cart.items = json.dumps(items)
+        cart = _find_cart(db, user_id)
+        if cart is None:
+            return jsonify({"message": "Item removed from cart", "items": []})
+        db.execute(delete(CartItem).where(CartItem.cart_id == cart.id, CartItem.product_id == product_id))
         db.commit()
-        
+
+        items, _ = _read_lines(db, cart.id)
         return jsonify({"message": "Item removed from cart", "items": items})
 
 
@@ -193,13 +346,11 @@ def clear_cart():
     user_id = session.get("user_id")
     if not user_id:
         return jsonify({"message": "Unauthorized"}), 401
-    
-    with SessionLocal() as db:
-        cart = _get_user_cart(db, user_id)
-        cart.items = "[]"
-        db.commit()
-        
-        return jsonify({"message": "Cart cleared"})
-
 
+    with SessionLocal() as db:
+        cart = _find_cart(db, user_id)
+        if cart is not None:
+            db.execute(delete(CartItem).where(CartItem.cart_id == cart.id))
+            db.commit()
 
+        return jsonify({"message": "Cart cleared"})
@@ -1,17 +1,16 @@
 from __future__ import annotations
 
-from flask import Blueprint, jsonify
-from sqlalchemy import select
-from sqlalchemy.orm import Session
+from flask import Blueprint, current_app, request
 
-from db import Category, SessionLocal
+import catalog_cache
 
 bp_categories = Blueprint("categories", __name__, url_prefix="/api")
 
 
 @bp_categories.get("/categories")
 def list_categories():
-    with SessionLocal() as session:  # type: Session
-        rows = list(session.scalars(select(Category)))
-        return jsonify([{"id": c.id, "name": c.name, "icon": c.icon} for c in rows])
-
+    snap = catalog_cache.get_snapshot()
+    resp = current_app.response_class(snap.categories_json(), mimetype="application/json")
+    resp.set_etag(snap.etag)
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp.make_conditional(request)
@@ -1,23 +1,62 @@
 from __future__ import annotations
 
-import asyncio
 import json
 import logging
-from typing import Any, Dict, List, Optional
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
 
 from flask import Blueprint, jsonify, request, session
+from sqlalchemy import and_, bindparam, or_, select, update
 from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import set_committed_value
 
+import catalog_cache
+import payments
+import sales_rollup
 from auth import require_firebase_auth
-from db import Order, Product, DeliveryAddress, PaymentMethod, User, Notification, SessionLocal
-from mpesa import initiate_stk_push
+from idempotency import idempotent
+from db import Order, Product, DeliveryAddress, PaymentMethod, User, SessionLocal, begin_write
+from low_stock import record_low_stock
+from order_items import add_order_items, cancel_orders
 
 logger = logging.getLogger(__name__)
 
 bp_orders = Blueprint("orders", __name__, url_prefix="/api")
 
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+
+def _parse_cursor(after: str) -> Tuple[datetime, int]:
+    """Order history cursors are "<created_at ISO>:<id>" of the last order seen"""
+    created_at, last_id = after.rsplit(":", 1)
+    return datetime.fromisoformat(created_at), int(last_id)
+
+
+def _decrement_stock(db: Session, quantities: Dict[int, int]) -> bool:
+    """
+    Guarded stock decrement: a row only changes while it still holds enough
+    stock, and in_stock is updated in the same statement, so concurrent
+    checkouts can never oversell. Returns False if any product fell short.
+    """
+    products = Product.__table__
+    stmt = (
+        update(products)
+        .where(products.c.id == bindparam("pid"), products.c.stock_quantity >= bindparam("qty"))
+        .values(
+            stock_quantity=products.c.stock_quantity - bindparam("qty"),
+            in_stock=(products.c.stock_quantity - bindparam("qty")) > 0,
+        )
+    )
+    params = [{"pid": pid, "qty": qty} for pid, qty in quantities.items()]
+    conn = db.connection()
+    if conn.dialect.supports_sane_multi_rowcount:
+        return conn.execute(stmt, params).rowcount == len(params)
+    return all(conn.execute(stmt, p).rowcount == 1 for p in params)
+
 
 @bp_orders.post("/orders")
+@idempotent
 def create_order():
     data = request.get_json(force=True) or {}
     user_id = session.get("user_id")
@@ -33,35 +72,45 @@ def create_order():
     calculated_subtotal = 0.0
     confirmed_items = []
     
+    product_ids = set()
+    for item in items_data:
+        try:
+            product_ids.add(int(item.get("id")))
+        except (TypeError, ValueError):
+            return jsonify({"message": f"Product {item.get('id')} not found"}), 400
+
     with SessionLocal() as db:  # type: Session
+        # Lock the ordered products up front (row locks, or the SQLite write
+        # lock) and load them all in one query
+        begin_write(db)
+        products = {
+            p.id: p
+            for p in db.scalars(
+                select(Product).where(Product.id.in_(product_ids)).order_by(Product.id).with_for_update()
+            )
+        }
+
         # Calculate subtotal from DB prices
+        ordered: Dict[int, int] = {}
+        low_stock: Dict[int, Tuple[int, int]] = {}
         for item in items_data:
-            product = db.query(Product).get(item.get("id"))
+            product = products.get(int(item.get("id")))
             if not product:
                 return jsonify({"message": f"Product {item.get('id')} not found"}), 400
             
             quantity = int(item.get("quantity", 1))
+            if quantity <= 0:
+                return jsonify({"message": f"Invalid quantity for {product.name}"}), 400
             
             # Check stock
-            if product.stock_quantity < quantity:
+            remaining = product.stock_quantity - ordered.get(product.id, 0) - quantity
+            if remaining < 0:
                 return jsonify({"message": f"Insufficient stock for {product.name}"}), 400
-
-            # Deduct stock
-            product.stock_quantity -= quantity
-            product.in_stock = product.stock_quantity > 0
+            ordered[product.id] = ordered.get(product.id, 0) + quantity
             
-            # Check for Low Stock (Reorder Logic)
-            if product.stock_quantity <= 5:
-                # Check if notification already exists for this product today (optional, to avoid spam)
-                # For simplicity, we'll just add it. Admin can clear them.
-                notification = Notification(
-                    title="Low Stock Alert",
-                    message=f"Product '{product.name}' is low on stock ({product.stock_quantity} remaining). Please reorder.",
-                    type="warning",
-                    user_id=None # None means visible to all admins or system-wide
-                )
-                db.add(notification)
-
+            # Check for Low Stock (Reorder Logic); alerts are coalesced per product
+            if remaining <= product.reorder_threshold:
+                low_stock[product.id] = (remaining, product.reorder_threshold)
             
             # Calculate item total
             price = float(product.price)
@@ -82,6 +131,20 @@ def create_order():
                 "total": item_total
             })
 
+        # Deduct stock
+        if not _decrement_stock(db, ordered):
+            db.rollback()
+            return jsonify({"message": "Insufficient stock for one or more items"}), 400
+        for product_id, quantity in ordered.items():
+            product = products[product_id]
+            set_committed_value(product, "stock_quantity", product.stock_quantity - quantity)
+            set_committed_value(product, "in_stock", product.stock_quantity > 0)
+
+        record_low_stock(db, low_stock)
+
+        # Stock changed, so cached catalog reads must pick it up
+        catalog_cache.bump_stock_version(db)
+
         # Calculate Delivery Fee (Fixed or based on rules)
         # For now, implementing a basic rule or trusting client if reasonable, but generally should be server side.
         # Im using the client's delivery fee if it matches server rules, otherwise defaulting.
@@ -95,7 +158,7 @@ def create_order():
         
         user = None
         if user_id:
-            user = db.query(User).get(user_id)
+            user = db.scalar(select(User).where(User.id == user_id).with_for_update())
             if user:
                  if loyalty_points_used > 0:
                      if user.loyalty_points < loyalty_points_used:
@@ -129,10 +192,13 @@ def create_order():
                 payment_method=data["paymentMethod"],
                 payment_status=data.get("paymentStatus", "pending"),
                 order_status=data.get("orderStatus", "processing"),
-                mpesa_transaction_id=None, # Will be set after STK push
+                mpesa_transaction_id=None, # Receipt number once paid
             )
             db.add(o)
             db.flush() # Get ID
+            add_order_items(db, o.id, confirmed_items)
+            if sales_rollup.is_counted(o):
+                sales_rollup.add_orders(db, [o.id])
             
             # ... (Address and Payment Method saving logic remains similar)
             # Save delivery address if user is logged in
@@ -161,6 +227,10 @@ def create_order():
                  if new_points > 0:
                      user.loyalty_points += new_points
                      user.total_spent += calculated_total
+
+            # STK push runs in the job worker; the job commits with the order
+            if data.get("paymentMethod") == "mpesa":
+                payments.enqueue_stk_push(db, o)
             
             db.commit()
             db.refresh(o)
@@ -173,44 +243,6 @@ def create_order():
             logger.error(f"Order creation error: {e}")
             return jsonify({"message": f"Order creation failed: {str(e)}"}), 500
 
-    # 2. Handle Payment (M-Pesa)
-    if data.get("paymentMethod") == "mpesa":
-        try:
-            phone = data["customerPhone"].strip()
-            if phone.startswith("0"):
-                phone = "254" + phone[1:]
-            elif not phone.startswith("254"):
-                phone = "254" + phone
-            
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            try:
-                # Initiate STK Push
-                result = loop.run_until_complete(
-                    initiate_stk_push(str(o.id), phone, float(calculated_total)) # Use server total
-                )
-                
-                # Store MerchantRequestID or CheckoutRequestID
-                # Assuming result is a dict like {'MerchantRequestID': '...', 'CheckoutRequestID': '...', ...}
-                if isinstance(result, dict):
-                    checkout_req_id = result.get('CheckoutRequestID')
-                    if checkout_req_id:
-                         with SessionLocal() as db_update:
-                             order_update = db_update.query(Order).get(o.id)
-                             if order_update:
-                                 # We are overloading mpesa_transaction_id to store the request ID initially
-                                 # When callback comes, we replace it with the Receipt Number
-                                 order_update.mpesa_transaction_id = f"REQ:{checkout_req_id}" 
-                                 db_update.commit()
-                
-                logger.info(f"STK push initiated for order {o.id}: {result}")
-            except Exception as stk_error:
-                logger.error(f"STK push failed for order {o.id}: {str(stk_error)}")
-            finally:
-                loop.close()
-        except Exception as e:
-            logger.error(f"Error processing M-Pesa payment for order {o.id}: {str(e)}")
-
     return jsonify(order_data)
 
 
@@ -220,14 +252,41 @@ def list_orders():
     if not user_id:
         return jsonify({"message": "Unauthorized"}), 401
     
-    with SessionLocal() as db:  # type: Session
-        orders = db.query(Order).filter(Order.user_id == user_id).order_by(Order.created_at.desc()).all()
-        # For list, we don't necessarily need the latest loyalty points in the order object, 
-        # or we could fetch the user once. 
-        return jsonify([_serialize_order(o) for o in orders])
+    status = request.args.get("status")
+    limit_arg = request.args.get("limit")
+    after_arg = request.args.get("after")
 
+    # Pagination is opt-in so existing clients that expect a bare list keep working;
+    # that list is still bounded, to the newest MAX_PAGE_SIZE orders
+    paginate = limit_arg is not None or after_arg is not None
+    try:
+        limit = int(limit_arg) if limit_arg else DEFAULT_PAGE_SIZE
+        after = _parse_cursor(after_arg) if after_arg else None
+    except ValueError:
+        return jsonify({"message": "Invalid limit or cursor"}), 400
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+
+    # Walks ix_orders_user_id_created_at in index order: newest first, id breaks ties
+    stmt = select(Order).where(Order.user_id == user_id).order_by(Order.created_at.desc(), Order.id)
+    if status:
+        stmt = stmt.where(Order.order_status == status)
+    if after is not None:
+        after_created, after_id = after
+        stmt = stmt.where(or_(
+            Order.created_at < after_created,
+            and_(Order.created_at == after_created, Order.id > after_id),
+        ))
 
-    return jsonify({"message": "Callback received"}), 200
+    with SessionLocal() as db:  # type: Session
+        if not paginate:
+            return jsonify([_serialize_order(o) for o in db.scalars(stmt.limit(MAX_PAGE_SIZE))])
+
+        # Fetch one extra row to know whether another page exists
+        orders = list(db.scalars(stmt.limit(limit + 1)))
+        has_more = len(orders) > limit
+        orders = orders[:limit]
+        next_cursor = f"{orders[-1].created_at.isoformat()}:{orders[-1].id}" if has_more else None
+        return jsonify({"items": [_serialize_order(o) for o in orders], "nextCursor": next_cursor})
 
 
 @bp_orders.post("/orders/<int:order_id>/cancel")
@@ -237,26 +296,20 @@ def cancel_order(order_id: int):
         return jsonify({"message": "Unauthorized"}), 401
     
     with SessionLocal() as db:
-        order = db.query(Order).get(order_id)
+        begin_write(db)
+        order = db.get(Order, order_id)
         if not order:
             return jsonify({"message": "Order not found"}), 404
         
         if order.user_id != user_id:
             return jsonify({"message": "Unauthorized"}), 403
-            
-        if order.payment_status != "pending":
-            return jsonify({"message": "Cannot cancel order that is not pending"}), 400
 
-        # Restore stock
-        items = json.loads(order.items)
-        for item in items:
-            product = db.query(Product).get(item["id"])
-            if product:
-                product.stock_quantity += item["quantity"]
-                product.in_stock = product.stock_quantity > 0
-        
-        order.order_status = "cancelled"
-        order.payment_status = "cancelled"
+        cancelled = cancel_orders(
+            db, [Order.id == order_id, Order.payment_status == "pending"], payment_status="cancelled"
+        )
+        if not cancelled:
+            db.rollback()
+            return jsonify({"message": "Cannot cancel order that is not pending"}), 400
         db.commit()
         
         return jsonify({"message": "Order cancelled successfully"})
@@ -279,77 +332,45 @@ def retry_payment(order_id: int):
         if order.payment_status != "pending":
              return jsonify({"message": "Order is not pending payment"}), 400
              
-        # Retry STK Push
-        phone = order.customer_phone
-        if phone.startswith("0"):
-            phone = "254" + phone[1:]
-        elif not phone.startswith("254"):
-            phone = "254" + phone
-            
-        try:
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            result = loop.run_until_complete(
-                initiate_stk_push(str(order.id), phone, float(order.total))
-            )
-            loop.close()
-            
-            if isinstance(result, dict):
-                checkout_req_id = result.get('CheckoutRequestID')
-                if checkout_req_id:
-                     order.mpesa_transaction_id = f"REQ:{checkout_req_id}"
-                     db.commit()
-                     
-            return jsonify({"message": "Payment initiated successfully"})
-        except Exception as e:
-            return jsonify({"message": f"Payment retry failed: {str(e)}"}), 500
+        # Repeated taps while a push is still queued don't pile up more prompts
+        if payments.stk_push_status(db, order.id) not in ("pending", "running"):
+            payments.enqueue_stk_push(db, order)
+            db.commit()
+        return jsonify({"message": "Payment initiated successfully", "paymentStatus": order.payment_status}), 202
+
+
+@bp_orders.get("/orders/<int:order_id>/payment-status")
+def payment_status(order_id: int):
+    """Polled by the client after checkout while the STK push runs in the background"""
+    user_id = session.get("user_id")
+    with SessionLocal() as db:
+        order = db.get(Order, order_id)
+        if not order:
+            return jsonify({"message": "Order not found"}), 404
+        if order.user_id is not None and order.user_id != user_id:
+            return jsonify({"message": "Unauthorized"}), 403
+
+        return jsonify({
+            "orderId": order.id,
+            "paymentStatus": order.payment_status,
+            "orderStatus": order.order_status,
+            "stkPushStatus": payments.stk_push_status(db, order.id),
+        })
 
 
 @bp_orders.post("/mpesa/callback")
 def mpesa_callback():
-    body = request.get_json(force=True) or {}
+    # Only persist the raw body here and acknowledge straight away; Safaricom
+    # retries slow callbacks, and the worker applies the inbox in batches
+    body = request.get_json(force=True, silent=True) or {}
     try:
-        stk = body["Body"]["stkCallback"]
-        checkout_req_id = stk.get("CheckoutRequestID")
-        result_code = stk.get("ResultCode")
+        checkout_req_id = payments.parse_stk_callback(body).checkout_request_id
     except Exception:
         return jsonify({"message": "Bad callback"}), 400
 
-    with SessionLocal() as session:
-        # Find order by Request ID
-        o = session.query(Order).filter(Order.mpesa_transaction_id == f"REQ:{checkout_req_id}").first()
-        
-        # Fallback if request ID not found (legacy)
-        if not o and result_code == 0: 
-             o = session.query(Order).filter(Order.payment_status == "pending", Order.payment_method == "mpesa").order_by(Order.created_at.desc()).first()
-
-        if o:
-            if result_code == 0:
-                receipt = None
-                for item in stk.get("CallbackMetadata", {}).get("Item", []):
-                    if item.get("Name") == "MpesaReceiptNumber":
-                        receipt = item.get("Value")
-                        break
-                
-                if receipt:
-                    o.payment_status = "completed"
-                    o.order_status = "paid" # Update order status to paid as well per requirement
-                    o.mpesa_transaction_id = receipt
-                    session.commit()
-                    logger.info(f"Payment confirmed for order {o.id}, Receipt: {receipt}")
-            else:
-                 # Handle failure
-                 # Don't cancel, just mark as failed or leave pending?
-                 # User asked: "if not it says pending" -> imply we might leave it or explicit 'payment_failed'
-                 # But let's log it clearly.
-                 # To allow retry without confusion, 'pending' is fine, but maybe 'failed' status helps UI show 'Retry'?
-                 # Let's keep it 'pending' as per user words "if not it says pending", but we can log failure meta if needed.
-                 # Actually, if we want to show it failed, we can set payment_status='failed' and 'Retry' button shows up.
-                 # But user said "if not it says pending", so I will strictly follow that for now, 
-                 # BUT I will update the logging.
-                 logger.warning(f"Payment failed for order {o.id}. Code: {result_code}, Desc: {stk.get('ResultDesc')}")
-        else:
-            logger.warning(f"Order not found for M-Pesa callback. ReqID: {checkout_req_id}")
+    with SessionLocal() as db:
+        payments.record_callback(db, request.get_data(as_text=True), checkout_req_id)
+        db.commit()
 
     return jsonify({"message": "Callback received"}), 200
 
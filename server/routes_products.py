@@ -1,67 +1,118 @@
 from __future__ import annotations
 
-from flask import Blueprint, jsonify, request
-from sqlalchemy import select
+from typing import Optional, Tuple
+
+from flask import Blueprint, Response, current_app, jsonify, request
+from sqlalchemy import and_, func, or_, select
 from sqlalchemy.orm import Session
 
+import catalog_cache
+import product_search
 from db import Product, SessionLocal
 
 bp_products = Blueprint("products", __name__, url_prefix="/api")
 
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+
+def _json_response(body: bytes) -> Response:
+    return current_app.response_class(body, mimetype="application/json")
+
+
+def _conditional(resp: Response, etag: str) -> Response:
+    # no-cache lets browsers and nginx keep the body but revalidate it every time
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp.make_conditional(request)
+
+
+def _parse_cursor(after: str) -> Tuple[Optional[float], int]:
+    """Cursors are "<id>" for id-ordered pages and "<score>:<id>" for ranked search pages"""
+    if ":" in after:
+        score, last_id = after.rsplit(":", 1)
+        return float(score), int(last_id)
+    return None, int(after)
+
 
 @bp_products.get("/products")
 def list_products():
     category = request.args.get("category")
     search = request.args.get("search")
+    limit_arg = request.args.get("limit")
+    after_arg = request.args.get("after")
+
+    # Pagination is opt-in so existing clients that expect a bare list keep working
+    paginate = limit_arg is not None or after_arg is not None
+    try:
+        limit = int(limit_arg) if limit_arg else DEFAULT_PAGE_SIZE
+        after_score, after_id = _parse_cursor(after_arg) if after_arg else (None, None)
+    except ValueError:
+        return jsonify({"message": "Invalid limit or cursor"}), 400
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+
+    if not search:
+        # Unfiltered and category reads are served from the catalog snapshot
+        snap = catalog_cache.get_snapshot()
+        cat = category if category and category != "all" else None
+        body = snap.page_json(cat, after_id, limit) if paginate else snap.list_json(cat)
+        return _conditional(_json_response(body), snap.etag)
+
+    # Search reads SQL directly, so it only needs the versions for its ETag
+    etag = catalog_cache.current_etag()
+
+    stmt = select(Product)
+    if category and category != "all":
+        stmt = stmt.where(Product.category == category)
+
+    hits = product_search.match_subquery(search)
+    if hits is not None:
+        # Ranked full-text search: order by BM25 score, id breaks ties
+        stmt = (
+            stmt.add_columns(hits.c.score)
+            .join(hits, hits.c.id == Product.id)
+            .order_by(hits.c.score, Product.id)
+        )
+        if after_id is not None:
+            if after_score is None:
+                return jsonify({"message": "Invalid limit or cursor"}), 400
+            stmt = stmt.where(or_(
+                hits.c.score > after_score,
+                and_(hits.c.score == after_score, Product.id > after_id),
+            ))
+    else:
+        s = search.lower()
+        stmt = stmt.where(or_(
+            func.lower(Product.name).contains(s, autoescape=True),
+            func.lower(func.coalesce(Product.description, "")).contains(s, autoescape=True),
+        ))
+        # Products are ordered by id so the cursor (last id seen) is stable across pages
+        stmt = stmt.order_by(Product.id)
+        if after_id is not None:
+            stmt = stmt.where(Product.id > after_id)
+
     with SessionLocal() as session:  # type: Session
-        products = list(session.scalars(select(Product)))
-        if category and category != "all":
-            products = [p for p in products if p.category == category]
-        if search:
-            s = search.lower()
-            products = [
-                p for p in products
-                if s in p.name.lower() or (p.description or "").lower().find(s) >= 0
-            ]
-        return jsonify([
-            {
-                "id": p.id,
-                "name": p.name,
-                "description": p.description or "",
-                "price": float(p.price) if p.price is not None else 0,
-                "image": p.image or "",
-                "category": p.category or "",
-                "size": p.size or "",
-                "stockQuantity": int(p.stock_quantity) if p.stock_quantity is not None else 0,
-                "inStock": bool(p.in_stock) if p.in_stock is not None else False,
-                "deliveryPrice": float(p.delivery_price) if p.delivery_price is not None else 0,
-                "discount": float(p.discount) if p.discount is not None else 0,
-                "createdAt": p.created_at.isoformat() if p.created_at else "",
-                "updatedAt": p.updated_at.isoformat() if p.updated_at else ""
-            }
-            for p in products
-        ])
+        if not paginate:
+            return _conditional(jsonify([catalog_cache.serialize_product(row[0]) for row in session.execute(stmt)]), etag)
+
+        # Fetch one extra row to know whether another page exists
+        rows = list(session.execute(stmt.limit(limit + 1)))
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        next_cursor = None
+        if has_more:
+            last = rows[-1]
+            next_cursor = f"{last.score!r}:{last[0].id}" if hits is not None else str(last[0].id)
+        return _conditional(jsonify({
+            "items": [catalog_cache.serialize_product(row[0]) for row in rows],
+            "nextCursor": next_cursor,
+        }), etag)
 
 
 @bp_products.get("/products/<int:pid>")
 def get_product(pid: int):
-    with SessionLocal() as session:  # type: Session
-        product = session.get(Product, pid)
-        if not product:
-            return jsonify({"message": "Product not found"}), 404
-        return jsonify({
-            "id": product.id,
-            "name": product.name,
-            "description": product.description or "",
-            "price": float(product.price) if product.price is not None else 0,
-            "image": product.image or "",
-            "category": product.category or "",
-            "size": product.size or "",
-            "stockQuantity": int(product.stock_quantity) if product.stock_quantity is not None else 0,
-            "inStock": bool(product.in_stock) if product.in_stock is not None else False,
-            "deliveryPrice": float(product.delivery_price) if product.delivery_price is not None else 0,
-            "discount": float(product.discount) if product.discount is not None else 0,
-            "createdAt": product.created_at.isoformat() if product.created_at else "",
-            "updatedAt": product.updated_at.isoformat() if product.updated_at else ""
-        })
-
+    snap = catalog_cache.get_snapshot()
+    body = snap.product_json(pid)
+    if body is None:
+        return jsonify({"message": "Product not found"}), 404
+    return _conditional(_json_response(body), snap.etag)
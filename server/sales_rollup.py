@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+"""
+Sales rollups: ``daily_sales`` per day and ``product_daily_sales`` per
+product per day.
+
+An order counts towards the day it was placed once it is paid and for as
+long as it isn't cancelled. Whatever changes an order's payment or
+cancellation calls add_orders / remove_orders in the same transaction, so
+the dashboard reads a handful of small rows instead of scanning orders,
+and top products over any date range is one query on the primary key.
+Distinct customers are a HyperLogLog sketch of customer phones; sketches
+only grow, so after cancellations they can overcount until the next
+rebuild. Rebuild (e.g. after a backfill or a bulk import) with:
+
+    cd server && python sales_rollup.py [--since YYYY-MM-DD]
+"""
+
+from __future__ import annotations
+
+import argparse
+import hashlib
+import math
+from datetime import date, datetime
+from typing import Dict, Iterable, Optional, Sequence, Tuple
+
+from sqlalchemy import delete, func, insert, select
+from sqlalchemy.orm import Session
+
+import order_items
+from db import DailySales, Order, OrderItem, ProductDailySales, SessionLocal, begin_write, dialect_insert
+
+PAID_STATUSES = ("completed", "paid", "success")
+
+SKETCH_PRECISION = 8  # 256 one-byte registers, ~6.5% standard error
+SKETCH_REGISTERS = 1 << SKETCH_PRECISION
+
+
+def is_counted(order: Order) -> bool:
+    """Whether the order belongs in the rollup"""
+    return order.payment_status in PAID_STATUSES and order.order_status != "cancelled"
+
+
+def empty_sketch() -> bytes:
+    return bytes(SKETCH_REGISTERS)
+
+
+def _sketch_add(registers: bytearray, value: str) -> None:
+    h = int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+    index = h >> (64 - SKETCH_PRECISION)
+    rest = h & ((1 << (64 - SKETCH_PRECISION)) - 1)
+    rank = (64 - SKETCH_PRECISION) - rest.bit_length() + 1
+    if rank > registers[index]:
+        registers[index] = rank
+
+
+def merge_sketches(sketches: Iterable[bytes]) -> bytes:
+    merged = bytearray(SKETCH_REGISTERS)
+    for sketch in sketches:
+        for i, rank in enumerate(sketch or b""):
+            if rank > merged[i]:
+                merged[i] = rank
+    return bytes(merged)
+
+
+def distinct_customers(sketches: Iterable[bytes]) -> int:
+    """Estimated number of distinct customers across the given days' sketches"""
+    registers = merge_sketches(sketches)
+    m = SKETCH_REGISTERS
+    estimate = 0.7213 / (1 + 1.079 / m) * m * m / sum(2.0 ** -r for r in registers)
+    zeros = registers.count(0)
+    if estimate <= 2.5 * m and zeros:
+        # Linear counting is far more accurate for small cardinalities
+        estimate = m * math.log(m / zeros)
+    return round(estimate)
+
+
+def _apply(db: Session, order_ids: Sequence[int], sign: int) -> None:
+    if not order_ids:
+        return
+    # An order that only has JSON items (e.g. a legacy pending order paid now) needs
+    # its lines written before its products can be counted
+    order_items.backfill_order_items(db, order_ids)
+    orders = db.execute(
+        select(Order.id, Order.created_at, Order.total, Order.customer_phone).where(Order.id.in_(order_ids))
+    ).all()
+    lines = db.execute(
+        select(OrderItem.order_id, OrderItem.product_id, func.sum(OrderItem.quantity), func.sum(OrderItem.line_total))
+        .where(OrderItem.order_id.in_(order_ids))
+        .group_by(OrderItem.order_id, OrderItem.product_id)
+    ).all()
+    order_days = {o.id: o.created_at.date().isoformat() for o in orders}
+
+    days: Dict[str, dict] = {}
+    for o in orders:
+        day = days.setdefault(order_days[o.id], {"revenue": 0.0, "orders": 0, "items": 0, "phones": set()})
+        day["revenue"] += float(o.total or 0)
+        day["orders"] += 1
+        if o.customer_phone:
+            day["phones"].add(o.customer_phone.strip())
+    if not days:
+        return
+    products: Dict[Tuple[str, int], list] = {}
+    for order_id, product_id, units, revenue in lines:
+        days[order_days[order_id]]["items"] += int(units or 0)
+        product = products.setdefault((order_days[order_id], product_id), [0, 0.0])
+        product[0] += int(units or 0)
+        product[1] += float(revenue or 0)
+
+    sketches = {
+        row.date: row.distinct_customers_sketch
+        for row in db.execute(
+            select(DailySales.date, DailySales.distinct_customers_sketch)
+            .where(DailySales.date.in_(list(days)))
+            .with_for_update()
+        )
+    }
+    rows = []
+    for key, day in days.items():
+        registers = bytearray(sketches.get(key) or empty_sketch())
+        if sign > 0:
+            for phone in day["phones"]:
+                _sketch_add(registers, phone)
+        rows.append({
+            "date": key,
+            "revenue": sign * day["revenue"],
+            "orders": sign * day["orders"],
+            "items": sign * day["items"],
+            "distinct_customers_sketch": bytes(registers),
+        })
+
+    stmt = dialect_insert(db)(DailySales)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["date"],
+        set_={
+            "revenue": DailySales.revenue + stmt.excluded["revenue"],
+            "orders": DailySales.orders + stmt.excluded["orders"],
+            "items": DailySales.items + stmt.excluded["items"],  # excluded.items is ColumnCollection.items()
+            "distinct_customers_sketch": stmt.excluded["distinct_customers_sketch"],
+        },
+    )
+    db.execute(stmt, rows)
+
+    if products:
+        stmt = dialect_insert(db)(ProductDailySales)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["date", "product_id"],
+            set_={
+                "units": ProductDailySales.units + stmt.excluded.units,
+                "revenue": ProductDailySales.revenue + stmt.excluded.revenue,
+            },
+        )
+        db.execute(stmt, [
+            {"date": key, "product_id": product_id, "units": sign * units, "revenue": sign * revenue}
+            for (key, product_id), (units, revenue) in products.items()
+        ])
+
+
+def add_orders(db: Session, order_ids: Sequence[int]) -> None:
+    """Count orders that just became paid, in the caller's transaction"""
+    _apply(db, order_ids, 1)
+
+
+def remove_orders(db: Session, order_ids: Sequence[int]) -> None:
+    """Take back orders that were counted and are now cancelled or unpaid, in the caller's transaction"""
+    _apply(db, order_ids, -1)
+
+
+def rebuild(db: Session, since: Optional[date] = None) -> int:
+    """Recompute both rollups from raw orders (from since on, if given). The caller commits. Returns the day count."""
+    counted = [Order.payment_status.in_(PAID_STATUSES), Order.order_status != "cancelled"]
+    if since:
+        counted.append(Order.created_at >= datetime.combine(since, datetime.min.time()))
+    day = func.date(Order.created_at)
+
+    # Items and products are summed from order_items, so counted orders that
+    # only have their JSON items (placed before the table, or bulk-inserted)
+    # get their lines written first
+    missing = list(db.scalars(
+        select(Order.id).where(*counted, ~select(OrderItem.id).where(OrderItem.order_id == Order.id).exists())
+    ))
+    order_items.backfill_order_items(db, missing)
+
+    rows: Dict[str, dict] = {}
+    for d, revenue, count in db.execute(select(day, func.sum(Order.total), func.count(Order.id)).where(*counted).group_by(day)):
+        rows[str(d)] = {"date": str(d), "revenue": float(revenue or 0), "orders": count, "items": 0,
+                        "distinct_customers_sketch": bytearray(SKETCH_REGISTERS)}
+    for d, quantity in db.execute(
+        select(day, func.sum(OrderItem.quantity))
+        .join(Order, Order.id == OrderItem.order_id)
+        .where(*counted)
+        .group_by(day)
+    ):
+        rows[str(d)]["items"] = int(quantity or 0)
+    for d, phone in db.execute(select(day, Order.customer_phone).where(*counted, Order.customer_phone.isnot(None)).distinct()):
+        _sketch_add(rows[str(d)]["distinct_customers_sketch"], phone.strip())
+
+    product_rows = [
+        {"date": str(d), "product_id": product_id, "units": int(units or 0), "revenue": float(revenue or 0)}
+        for d, product_id, units, revenue in db.execute(
+            select(day, OrderItem.product_id, func.sum(OrderItem.quantity), func.sum(OrderItem.line_total))
+            .join(Order, Order.id == OrderItem.order_id)
+            .where(*counted)
+            .group_by(day, OrderItem.product_id)
+        )
+    ]
+
+    for table in (DailySales, ProductDailySales):
+        db.execute(delete(table).where(table.date >= since.isoformat()) if since else delete(table))
+    if rows:
+        for row in rows.values():
+            row["distinct_customers_sketch"] = bytes(row["distinct_customers_sketch"])
+        db.execute(insert(DailySales), list(rows.values()))
+    if product_rows:
+        db.execute(insert(ProductDailySales), product_rows)
+    return len(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild the sales rollups from orders")
+    parser.add_argument("--since", type=date.fromisoformat, help="only rebuild days from YYYY-MM-DD on")
+    args = parser.parse_args()
+
+    with SessionLocal() as db:
+        # Holds the write lock so no order changes between the scan and the rewrite
+        begin_write(db)
+        days = rebuild(db, args.since)
+        db.commit()
+    print(f"✓ Rebuilt sales rollups for {days} days")
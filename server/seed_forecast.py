@@ -2,6 +2,8 @@ import random
 from datetime import datetime, timedelta
 from app import app
 from db import SessionLocal, Order, User, Product
+from order_items import add_order_items
+import sales_rollup
 import json
 
 def seed_forecast_data():
@@ -19,6 +21,7 @@ def seed_forecast_data():
         start_date = end_date - timedelta(days=90)
         
         orders_to_add = []
+        lines_to_add = []
         
         print(f"Generating orders from {start_date.date()} to {end_date.date()}...")
         
@@ -55,7 +58,8 @@ def seed_forecast_data():
                         "name": p.name,
                         "price": p.price,
                         "quantity": quantity,
-                        "image": p.image
+                        "image": p.image,
+                        "total": item_total
                     })
                 
                 delivery_fee = 100.0  # Standard fee
@@ -77,12 +81,20 @@ def seed_forecast_data():
                     created_at=current_date + timedelta(hours=random.randint(8, 20), minutes=random.randint(0, 59))
                 )
                 orders_to_add.append(order)
+                lines_to_add.append(order_items)
             
             current_date += timedelta(days=1)
             
         session.add_all(orders_to_add)
+        session.flush()
+        # Analytics and cancellation read lines from order_items, not the JSON copy
+        for order, lines in zip(orders_to_add, lines_to_add):
+            add_order_items(session, order.id, lines)
+        # The orders are inserted as paid, so the analytics rollups must include them
+        days = sales_rollup.rebuild(session)
         session.commit()
         print(f"Successfully added {len(orders_to_add)} mock orders.")
+        print(f"Rebuilt sales rollups for {days} days.")
 
 if __name__ == "__main__":
     seed_forecast_data()
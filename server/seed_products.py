@@ -5,6 +5,8 @@ Seed script to add sample products with images to the database.
 
 from __future__ import annotations
 
+import catalog_cache
+import product_search
 from db import Base, SessionLocal, Product, engine
 
 # Sample products with images
@@ -179,6 +181,7 @@ PRODUCTS = [
 def main() -> None:
     """Seed products into the database"""
     Base.metadata.create_all(engine)
+    product_search.ensure_index(engine)
     
     with SessionLocal() as session:
         # Check if products already exist
@@ -206,7 +209,9 @@ def main() -> None:
             session.add(product)
             added_count += 1
         
+        catalog_cache.bump_version(session)
         session.commit()
+        product_search.rebuild_index(engine)
         print(f"Successfully added {added_count} products to the database!")
 
 
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Stress test for concurrent checkouts against a single SKU.
+
+Fires CHECKOUTS parallel POST /api/orders requests from THREADS threads at
+one product with STOCK units and verifies that nothing is oversold: the
+number of accepted orders must equal the stock consumed, and stock never
+goes negative. Runs against a throwaway SQLite database:
+
+    cd server && python stress_checkout.py [checkouts] [threads] [stock]
+"""
+
+from __future__ import annotations
+
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+_tmpdir = tempfile.mkdtemp(prefix="checkout-stress-")
+os.environ["DATABASE_URL"] = f"sqlite:///{_tmpdir}/stress.db"
+os.environ.setdefault("FLASK_SECRET_KEY", "checkout-stress")
+
+from app import app  # noqa: E402
+from db import Order, Product, SessionLocal  # noqa: E402
+
+CHECKOUTS = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+THREADS = int(sys.argv[2]) if len(sys.argv) > 2 else 32
+STOCK = int(sys.argv[3]) if len(sys.argv) > 3 else 100
+
+_local = threading.local()
+
+
+def seed() -> int:
+    with SessionLocal() as db:
+        product = Product(name="Hot SKU", price=100.0, image="", category="stress",
+                          stock_quantity=STOCK, in_stock=True)
+        db.add(product)
+        db.commit()
+        return product.id
+
+
+def checkout(product_id: int) -> int:
+    client = getattr(_local, "client", None)
+    if client is None:
+        client = _local.client = app.test_client()
+    r = client.post("/api/orders", json={
+        "items": [{"id": product_id, "quantity": 1}],
+        "customerName": "Stress",
+        "customerPhone": "0700000000",
+        "deliveryAddress": "Nairobi",
+        "paymentMethod": "cash",
+    })
+    return r.status_code
+
+
+def main() -> int:
+    product_id = seed()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=THREADS) as pool:
+        statuses = Counter(pool.map(checkout, [product_id] * CHECKOUTS))
+    elapsed = time.perf_counter() - start
+
+    with SessionLocal() as db:
+        product = db.get(Product, product_id)
+        orders = db.query(Order).count()
+        remaining, in_stock = product.stock_quantity, product.in_stock
+
+    accepted = statuses.get(200, 0)
+    print(f"{CHECKOUTS} checkouts on {THREADS} threads, stock {STOCK}: {dict(statuses)}")
+    print(f"accepted {accepted}, orders stored {orders}, stock left {remaining}, in_stock {in_stock}")
+    print(f"throughput {CHECKOUTS / elapsed:.0f} checkouts/s ({elapsed * 1000 / CHECKOUTS:.2f} ms avg)")
+
+    oversold = accepted - (STOCK - remaining)
+    ok = (
+        remaining >= 0
+        and oversold == 0
+        and orders == accepted
+        and accepted == min(STOCK, CHECKOUTS)
+        and in_stock == (remaining > 0)
+    )
+    print("OK: no oversell" if ok else f"FAIL: oversold by {oversold}")
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,23 @@
+#!/usr/bin/env python3
+"""
+Background job worker. Runs queued jobs such as M-Pesa STK pushes, plus
+the periodic callback inbox, payment reconciliation and low-stock alert
+tasks:
+
+    cd server && python worker.py
+"""
+
+from __future__ import annotations
+
+import logging
+
+import jobs
+import low_stock  # noqa: F401  (registers low-stock notification sync)
+import payments  # noqa: F401  (registers the stk_push handler and callback inbox)
+import reconcile_payments  # noqa: F401  (registers payment reconciliation)
+from db import Base, engine
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    Base.metadata.create_all(engine)
+    jobs.run_worker()